@@ -20,14 +20,16 @@
 
 import os, re, sys, string, stat
 import threading
+import concurrent.futures
 try:
     import queue
 except ImportError:
     import Queue as queue
 import logging
+from collections import OrderedDict
 from minidinstall_ng import DpkgControl, SignedFile
-from minidinstall_ng import misc
 from minidinstall_ng import hasher
+from minidinstall_ng.packageindex import stat_key
 
 class ChangeFileException(Exception):
 
@@ -37,6 +39,64 @@ class ChangeFileException(Exception):
     def __str__(self):
         return str(self._value)
 
+class VerifiedFileMemo(object):
+    '''
+    Remembers files which already passed the checksum verification, so
+    retries of an incomplete upload only hash new or changed files.
+
+    An entry is only valid as long as size, mtime and inode of the file
+    stay the same and the expected checksums don't change.
+
+    :param max_entries: The oldest entries are dropped above this size.
+    '''
+    def __init__(self, max_entries=10000):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+
+    def verified(self, filename, key, hashsums):
+        with self._lock:
+            return self._entries.get(filename) == (key, hashsums)
+
+    def add(self, filename, key, hashsums):
+        with self._lock:
+            self._entries.pop(filename, None)
+            self._entries[filename] = (key, dict(hashsums))
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, filename):
+        with self._lock:
+            self._entries.pop(filename, None)
+
+class ChangeFileEntry(object):
+    '''
+    A file of an upload as listed in the changes file. Checksums missing
+    from the changes file are :const:`None`.
+    '''
+    __slots__ = ('filename', 'size', 'section', 'priority', 'md5', 'sha1', 'sha256')
+
+    def __init__(self, filename, size, section=None, priority=None,
+                 md5=None, sha1=None, sha256=None):
+        self.filename = filename
+        self.size = size
+        self.section = section
+        self.priority = priority
+        self.md5 = md5
+        self.sha1 = sha1
+        self.sha256 = sha256
+
+    @property
+    def hashsums(self):
+        '''
+        Dictionary mapping the hashing methods to the expected hex digests.
+        '''
+        return dict((hash, getattr(self, hash)) for hash in ChangeFile.hashes
+                    if not getattr(self, hash) is None)
+
+    def __repr__(self):
+        return 'ChangeFileEntry(%r, %d)' % (self.filename, self.size)
+
 class ChangeFile(DpkgControl.DpkgParagraph):
     '''
     Object representing a changefile.
@@ -54,56 +114,141 @@ class ChangeFile(DpkgControl.DpkgParagraph):
         DpkgControl.DpkgParagraph.__init__(self)
         self._logger = logging.getLogger("mini-dinstall")
         self._file = ''
+        #: :class:`ChangeFileEntry` list, parsed on first use
+        self._entries = None
+        #: The :class:`SignedFile.SignedFile` (buffer mode) the data was
+        #: loaded from. Its :attr:`raw` content can be handed to the
+        #: signature check without reading the file again.
+        self.signed_file = None
 
     def load_from_file(self, filename):
+        '''
+        :raises ChangeFileException: If the file can't be read, decoded or
+                                     parsed.
+        '''
         self._file = filename
-        f = SignedFile.SignedFile(open(self._file))
-        self.load(f)
-        f.close()
+        try:
+            f = SignedFile.SignedFile.from_file(self._file)
+            self.load_buffer(f.buffer, start=f.body_start, end=f.body_end)
+        except EnvironmentError as e:
+            raise ChangeFileException("Can't read %s: %s" % (filename, e.strerror))
+        except ValueError as e:
+            # UnicodeDecodeError is a ValueError too
+            raise ChangeFileException("Can't parse %s: %s" % (filename, e))
+        self.signed_file = f
+        self._entries = None
 
     @classmethod
     def from_file(cls, filename):
         obj = cls()
         obj.load_from_file(filename)
+        return obj
 
     def getFiles(self):
-        return self._get_checksum_from_changes()['md5']
+        '''
+        Returns the files of the upload as list of :class:`ChangeFileEntry`
+        objects. The checksum fields are only parsed once.
+        '''
+        if self._entries is None:
+            self._entries = self._parse_entries()
+        return self._entries
 
-    def _get_checksum_from_changes(self):
+    def _parse_entries(self):
         """ extract checksums and size from changes file """
-        output = {}
+        entries = OrderedDict()
         if not 'files' in self:
-            return output
+            return []
         for hash, (hash_key, regex) in self.hashes.items():
             if not hash_key in self:
                 self._logger.warn("Can't find %s checksum in changes file '%s'" % (hash, os.path.basename(self._file)))
                 continue
-            output[hash] = []
             for line in self[hash_key]:
                 if line == '':
                     continue
                 match = regex.match(line)
                 if match is None:
                     raise ChangeFileException("Couldn't parse file entry \"%s\" in Files field of .changes" % line)
-                output[hash].append((match.group(hash), int(match.group('size')), match.group('file'))
-        return output
+                filename = match.group('file')
+                size = int(match.group('size'))
+                entry = entries.get(filename)
+                if entry is None:
+                    entry = entries[filename] = ChangeFileEntry(filename, size)
+                elif entry.size != size:
+                    raise ChangeFileException("Different sizes given for %s in .changes" % (filename,))
+                setattr(entry, hash, match.group(hash))
+                if hash == 'md5':
+                    entry.section = match.group('section')
+                    entry.priority = match.group('priority')
+        return list(entries.values())
+
+    def check_sizes(self, sourcedir, skip=()):
+        '''
+        Cheap check whether the files of the upload reached their final
+        size. The files are only stat'ed, not read.
+
+        :param sourcedir: The directory containing the files.
+        :param skip: Filenames which are already known to be complete.
+        :returns: A tuple of the list of files having their final size and
+                  a dictionary mapping every other file to a tuple of its
+                  current size (0 if it's missing) and the expected size.
+        '''
+        complete = []
+        incomplete = {}
+        for entry in self.getFiles():
+            if entry.filename in skip:
+                continue
+            try:
+                statbuf = os.stat(os.path.join(sourcedir, entry.filename))
+            except OSError:
+                incomplete[entry.filename] = (0, entry.size)
+                continue
+            if stat.S_ISREG(statbuf.st_mode) and statbuf.st_size == entry.size:
+                complete.append(entry.filename)
+            else:
+                incomplete[entry.filename] = (statbuf.st_size, entry.size)
+        return complete, incomplete
 
-    def verify(self, sourcedir):
+    def verify(self, sourcedir, max_workers=4, memo=None):
         '''
         verify size and hash values from changes file
+
+        The files are checked by up to *max_workers* threads, each file
+        is read only once for all hashes. The first mismatch cancels the
+        remaining checks and is raised as :exc:`ChangeFileException`.
+
+        :param memo: Optional :class:`VerifiedFileMemo`. Files in it are
+                     not hashed again, verified files are added.
         '''
-        checksums = self._get_checksum_from_changes()
-        for hash, (hashsum, size, filename) in checksum[hash].items():
-            self._verify_file_integrity(os.path.join(sourcedir, filename), size, hash, hashsum)
+        entries = self.getFiles()
+        if not entries:
+            return
+        cancel_event = threading.Event()
+        workers = max(1, min(max_workers, len(entries)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._verify_file_integrity,
+                                       os.path.join(sourcedir, entry.filename),
+                                       entry.size, entry.hashsums, cancel_event, memo)
+                       for entry in entries]
+            done, pending = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            if pending:
+                # we got an error, stop the others
+                cancel_event.set()
+                for future in pending:
+                    future.cancel()
+        for future in done:
+            if not future.exception() is None:
+                raise future.exception()
 
 
-    def _verify_file_integrity(self, filename, expected_size, hash, expected_hashsum):
+    def _verify_file_integrity(self, filename, expected_size, expected_hashsums, cancel_event=None, memo=None):
         '''
         Check a files hash, size.
         :param filename: The file to check.
         :param excepted_size: The size of the file.
-        :param hash: The hashing method.
-        :param excepted_hash: The expected hex digest. 
+        :param expected_hashsums: Dictionary mapping the hashing methods to
+                                  the expected hex digests.
+        :param cancel_event: Stops the check if set.
+        :param memo: Optional :class:`VerifiedFileMemo`.
 
         Raises an :exc:`ChangeFileException` if the file doesn't match the expedted values.
         '''
@@ -117,8 +262,59 @@ class ChangeFile(DpkgControl.DpkgParagraph):
             raise ChangeFileException("Can't stat %s: %s" % (filename,e.strerror))
         if size != expected_size:
             raise ChangeFileException("File size for %s does not match that specified in .dsc" % (filename,))
-        if (hasher.hash_file(hash, filename) != expected_hashsum):
-            raise ChangeFileException("%ssum for %s does not match that specified in .dsc" % (hash, filename,))
-        self._logger.debug('Verified %ssum %s and size %s for %s' % (hash, expected_hashsum, expected_size, filename))
+        key = stat_key(statbuf)
+        if not memo is None and memo.verified(filename, key, expected_hashsums):
+            self._logger.debug('%s is unchanged since its last verification' % filename)
+            return
+        try:
+            result = hasher.hash_file_multi(filename, list(expected_hashsums), cancel_event)
+        except EnvironmentError as e:
+            # removed or replaced since the stat above
+            raise ChangeFileException("Can't read %s: %s" % (filename, e.strerror))
+        if result is None:
+            # cancelled
+            return
+        for hash, expected_hashsum in expected_hashsums.items():
+            if result[1][hash] != expected_hashsum:
+                raise ChangeFileException("%ssum for %s does not match that specified in .dsc" % (hash, filename,))
+        if not memo is None:
+            memo.add(filename, key, expected_hashsums)
+        self._logger.debug('Verified %s sums and size %s for %s' % ('/'.join(sorted(expected_hashsums)), expected_size, filename))
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import unittest
+
+    class TestChangeFile(unittest.TestCase):
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _write(self, data):
+            filename = os.path.join(self.dir, 'foo_1_amd64.changes')
+            with open(filename, 'wb') as f:
+                f.write(data)
+            return filename
+
+        def test_load(self):
+            changefile = ChangeFile.from_file(self._write(b'Source: foo\nDistribution: unstable\n'))
+            self.assertEqual(changefile['distribution'], 'unstable')
+
+        def test_garbage(self):
+            filename = self._write(b'Source: foo\nthis is no field\n')
+            self.assertRaises(ChangeFileException, ChangeFile.from_file, filename)
+
+        def test_not_utf8(self):
+            filename = self._write(b'Source: foo\nMaintainer: J\xf6rg\n')
+            self.assertRaises(ChangeFileException, ChangeFile.from_file, filename)
+
+        def test_missing(self):
+            filename = os.path.join(self.dir, 'missing.changes')
+            self.assertRaises(ChangeFileException, ChangeFile.from_file, filename)
+
+    unittest.main()
 
 # vim:ts=4:sw=4:et:
\ No newline at end of file
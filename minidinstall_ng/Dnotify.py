@@ -18,26 +18,71 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
-import os, re, sys, string, stat, threading, Queue, time
+import os, re, sys, string, stat, threading, time
+import errno, select, struct
+import ctypes, ctypes.util
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
 import logging
-from minidinstall import misc
+from minidinstall_ng.dirsnapshot import DirectorySnapshot
 
 class DnotifyException(Exception):
     def __init__(self, value):
         self._value = value
     def __str__(self):
-        return `self._value`
+        return repr(self._value)
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError):
+            libc = False
+        _libc = libc
+    return _libc
+
+def inotify_available():
+    '''
+    Whether the C library supports inotify (Linux only).
+    '''
+    return bool(_get_libc())
 
 class DirectoryNotifierFactory:
-    def create(self, dirs, use_dnotify=1, poll_time=30, logger=None, cancel_event=None):
-        if use_dnotify and os.access('/usr/bin/dnotify', os.X_OK):
+    def create(self, dirs, use_dnotify=1, poll_time=30, logger=None, cancel_event=None, use_inotify=1, file_filter=None):
+        '''
+        :param file_filter: Optional callable which gets a filename and
+                            returns whether changes of the file are
+                            reported. The dnotify backend ignores it.
+        '''
+        if use_inotify and inotify_available():
+            if logger:
+                logger.debug("Using inotify directory notifier")
+            return InotifyDirectoryNotifier(dirs, logger, cancel_event=cancel_event, file_filter=file_filter)
+        elif use_dnotify and os.access('/usr/bin/dnotify', os.X_OK):
             if logger:
                 logger.debug("Using dnotify directory notifier")
             return DnotifyDirectoryNotifier(dirs, logger)
         else:
             if logger:
                 logger.debug("Using mtime-polling directory notifier")
-            return MtimeDirectoryNotifier(dirs, poll_time, logger, cancel_event=cancel_event)
+            return MtimeDirectoryNotifier(dirs, poll_time, logger, cancel_event=cancel_event, file_filter=file_filter)
 
 class DnotifyNullLoggingFilter(logging.Filter):
     def filter(self, record):
@@ -60,6 +105,78 @@ class DirectoryNotifier:
     def cancelled(self):
         return self._cancel_event.isSet()
 
+class EventBatch(object):
+    '''
+    The events collected by :class:`EventCoalescer`.
+    '''
+    def __init__(self):
+        #: The changed directories, each listed once.
+        self.dirs = []
+        #: Whether a general change (a :const:`None` event) was seen.
+        self.general = False
+        #: :class:`threading.Event` objects to set once the batch is handled.
+        self.events = []
+        #: All other objects in the order they arrived.
+        self.others = []
+
+    def add(self, obj):
+        if obj is None:
+            self.general = True
+        elif isinstance(obj, str):
+            if not obj in self.dirs:
+                self.dirs.append(obj)
+        elif isinstance(obj, threading.Event):
+            self.events.append(obj)
+        else:
+            self.others.append(obj)
+
+class EventCoalescer(object):
+    '''
+    Collects the events put into *queue* (usually by a
+    :class:`DirectoryNotifierAsyncWrapper`) into batches, so a burst of
+    changes is handled once instead of once per event.
+
+    :param queue: The event queue.
+    :param quiet_time: A batch is complete after no new event arrived for
+                       this many seconds.
+    :param max_delay: A batch is complete at the latest this many seconds
+                      after its first event, even if events keep arriving.
+    :param cancel_event: Stops collecting when it is set.
+    '''
+    def __init__(self, queue, quiet_time=1, max_delay=10, cancel_event=None):
+        self._queue = queue
+        self.quiet_time = quiet_time
+        self.max_delay = max_delay
+        if cancel_event is None:
+            self._cancel_event = threading.Event()
+        else:
+            self._cancel_event = cancel_event
+
+    def get(self, timeout=None):
+        '''
+        Waits up to *timeout* seconds for an event and collects all events
+        following it.
+
+        :returns: An :class:`EventBatch` or :const:`None` if no event
+                  arrived in time.
+        '''
+        try:
+            obj = self._queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+        batch = EventBatch()
+        deadline = time.time() + self.max_delay
+        while True:
+            batch.add(obj)
+            wait = min(self.quiet_time, deadline - time.time())
+            if wait <= 0 or self._cancel_event.isSet():
+                break
+            try:
+                obj = self._queue.get(timeout=wait)
+            except Queue.Empty:
+                break
+        return batch
+
 class DirectoryNotifierAsyncWrapper(threading.Thread):
     def __init__(self, dnotify, queue, logger=None, name=None):
         if not name is None:
@@ -85,13 +202,18 @@ class DirectoryNotifierAsyncWrapper(threading.Thread):
         self._logger.info('Caught cancel event; async dnotify thread exiting')
 
 class MtimeDirectoryNotifier(DirectoryNotifier):
-    def __init__(self, dirs, poll_time, logger, cancel_event=None):
+    '''
+    Polls the directories every *poll_time* seconds and compares
+    snapshots of their files, so changes within the same second aren't
+    missed.
+    '''
+    def __init__(self, dirs, poll_time, logger, cancel_event=None, file_filter=None):
         DirectoryNotifier.__init__(self, dirs, logger, cancel_event=cancel_event)
         self._changed = []
         self._dirmap = {}
         self._polltime = poll_time
         for dir in dirs:
-            self._dirmap[dir] = os.stat(os.path.join(self._cwd, dir)).st_mtime
+            self._dirmap[dir] = DirectorySnapshot(os.path.join(self._cwd, dir), filter=file_filter)
     
     def poll(self, timeout=None):
         timeout_time = None
@@ -102,12 +224,12 @@ class MtimeDirectoryNotifier(DirectoryNotifier):
                 return None
             self._logger.debug('Polling...')
             for dir in self._dirmap.keys():
-                oldtime = self._dirmap[dir]
-                mtime = os.stat(os.path.join(self._cwd, dir)).st_mtime
-                if oldtime < mtime:
+                old = self._dirmap[dir]
+                new = old.rescan()
+                if old.diff(new):
                     self._logger.debug('Directory "%s" has changed' % (dir,))
                     self._changed.append(dir)
-                self._dirmap[dir] = mtime
+                self._dirmap[dir] = new
             if self._changed == []:
                 tmp_poll_time = self._polltime
                 while tmp_poll_time > 0:
@@ -117,11 +239,98 @@ class MtimeDirectoryNotifier(DirectoryNotifier):
                         wait = 1
                     else:
                         wait = tmp_poll_time
+                    time.sleep(wait)
                     tmp_poll_time -= 1
         ret = self._changed[0]
         self._changed = self._changed[1:]
         return ret
 
+class InotifyDirectoryNotifier(DirectoryNotifier):
+    '''
+    Watches the directories with the Linux inotify API. Files which are
+    completely written, moved into, moved out of or deleted from a
+    directory are reported immediately and without a child process.
+    '''
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+
+    def __init__(self, dirs, logger, cancel_event=None, file_filter=None):
+        DirectoryNotifier.__init__(self, dirs, logger, cancel_event=cancel_event)
+        self._file_filter = file_filter
+        libc = _get_libc()
+        if not libc:
+            raise DnotifyException('inotify is not available')
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._changed = []
+        #: watch descriptor => directory
+        self._watches = {}
+        for dir in dirs:
+            path = os.fsencode(os.path.join(self._cwd, dir))
+            wd = libc.inotify_add_watch(self._fd, path, self.mask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                os.close(self._fd)
+                raise OSError(err, 'Can\'t watch directory %s: %s' % (dir, os.strerror(err)))
+            self._watches[wd] = dir
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __del__(self):
+        self.close()
+
+    def _mark_changed(self, dir):
+        if not dir in self._changed:
+            self._logger.debug('Directory "%s" has changed' % (dir,))
+            self._changed.append(dir)
+
+    def _read_events(self):
+        try:
+            buf = os.read(self._fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        offset = 0
+        while offset + _INOTIFY_EVENT.size <= len(buf):
+            wd, mask, cookie, length = _INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += _INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # we lost events; everything may have changed
+                for dir in self._watches.values():
+                    self._mark_changed(dir)
+            elif wd in self._watches:
+                if not self._file_filter is None and length:
+                    name = buf[offset - length:offset].rstrip(b'\0')
+                    if not self._file_filter(os.fsdecode(name)):
+                        continue
+                self._mark_changed(self._watches[wd])
+
+    def poll(self, timeout=None):
+        timeout_time = None
+        if timeout:
+            timeout_time = time.time() + timeout
+        while not self._changed:
+            if self._cancel_event.isSet():
+                return None
+            # wake up at least every second to check the cancel event
+            wait = 1
+            if timeout_time:
+                wait = min(wait, timeout_time - time.time())
+                if wait <= 0:
+                    return None
+            try:
+                readable = select.select([self._fd], [], [], wait)[0]
+            except InterruptedError:
+                continue
+            if readable:
+                self._read_events()
+        return self._changed.pop(0)
+
 class DnotifyDirectoryNotifier(DirectoryNotifier):
     def __init__(self, dirs, logger):
         DirectoryNotifier.__init__(self, dirs, logger)
@@ -130,38 +339,11 @@ class DnotifyDirectoryNotifier(DirectoryNotifier):
         dnotify.start()
         
     def poll(self, timeout=None):
-        # delete duplicates
-        i = self._queue.qsize()
-        self._logger.debug('Queue size: %d', (i,))
-        set = {}
-        while i > 0:
-            dir = self._queue_get(timeout)
-            if dir is None:
-                # We shouldn't have to do this; no one else is reading
-                # from the queue.  But we do it just to be safe.
-                for key in set.keys():
-                    self._queue.put(key)
-                return None
-            set[dir] = 1
-            i -= 1
-        for key in set.keys():
-            self._queue.put(key)
-        i = self._queue.qsize()
-        self._logger.debug('Queue size (after duplicate filter): %d', (i,))
-        return self._queue_get(timeout)
-
-    def _queue_get(self, timeout):
-        if timeout is None:
-            return self._queue.get()
-        timeout_time = time.time() + timeout
-        while 1:
-            try:
-                self._queue.get(0)
-            except Queue.Empty:
-                if time.time() > timeout_time:
-                    return None
-                else:
-                    time.sleep(15)
+        # duplicates are filtered by the EventCoalescer of the consumer
+        try:
+            return self._queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
 
 class DnotifyThread(threading.Thread):
     def __init__(self, queue, dirs, logger):
@@ -176,7 +358,7 @@ class DnotifyThread(threading.Thread):
         pid = os.fork()
         if pid == 0:
             os.close(infd)
-            misc.dup2(outfd, 1)
+            os.dup2(outfd, 1)
             args = ['dnotify', '-m', '-c', '-d', '-a', '-r'] + list(self._dirs) + ['-e', 'printf', '"{}\\0"']
             os.execv('/usr/bin/dnotify', args)
             os.exit(1)
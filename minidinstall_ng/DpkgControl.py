@@ -13,6 +13,18 @@ DpkgSourceControl grabs the first paragraph from the file object, stores
 it in object.source, then passes control to DpkgControl.load, to parse
 the rest of the file.
 
+parse_paragraphs parses a buffer (bytes, str or mmap) instead of a file
+object. The buffer is decoded in pieces of about a megabyte, each split
+into paragraphs and lines once, so a mapped Packages or Sources file is
+neither read line by line nor decoded as a whole. This is about a third
+faster than DpkgParagraph.load.
+DpkgParagraph.load_buffer, DpkgControl.load_buffer and
+DpkgControl.load_file use it.
+
+iter_lazy_paragraphs doesn't parse at all: it yields LazyParagraph
+objects which only remember where their paragraph is in the buffer and
+search and decode a field when it is accessed.
+
 To test this, pass it a filetype char, a filename, then, optionally,
 the key to a paragraph to display, and if a fourth arg is given, only
 show that field.
@@ -34,12 +46,196 @@ show that field.
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
-__all__ = ['DpkgParagraph', 'DpkgControl', 'DpkgSourceControl']
+__all__ = ['DpkgParagraph', 'DpkgControl', 'DpkgSourceControl', 'parse_paragraphs',
+           'LazyParagraph', 'iter_lazy_paragraphs']
 
+import functools
+import mmap
+import os
+import re
 import sys
-from DpkgDatalist import *
-from minidinstall.SignedFile import *
-from types import ListType
+from collections.abc import Mapping
+from minidinstall_ng.DpkgDatalist import *
+from minidinstall_ng.SignedFile import *
+
+#: Size of the pieces a buffer is decoded and scanned in
+_CHUNK_SIZE = 1 << 20
+
+def _chunks(buf, pos, size, encoding):
+    '''
+    Yields the range from *pos* to *size* of *buf* decoded in pieces of
+    about :data:`_CHUNK_SIZE`, each ending between two paragraphs.
+    '''
+    separator = '\n\n' if isinstance(buf, str) else b'\n\n'
+    while pos < size:
+        cut = buf.find(separator, min(pos + _CHUNK_SIZE, size), size)
+        cut = size if cut == -1 else cut + 1
+        text = buf[pos:cut]
+        if not isinstance(text, str):
+            text = text.decode(encoding)
+        yield text
+        pos = cut
+
+def _paragraph_spans(buf, pos=0, size=None):
+    '''
+    Yields start and end offsets of the paragraphs in *buf*. The end
+    includes the newline of the last line. Only the range from *pos* to
+    *size* is searched.
+    '''
+    if isinstance(buf, str):
+        newline, separator = '\n', '\n\n'
+    else:
+        newline, separator = b'\n', b'\n\n'
+    if size is None:
+        size = len(buf)
+    while pos < size:
+        # skip blank lines between paragraphs
+        while pos < size and buf[pos:pos + 1] == newline:
+            pos += 1
+        if pos >= size:
+            return
+        end = buf.find(separator, pos, size)
+        if end == -1:
+            yield pos, size
+            return
+        yield pos, end + 1
+        pos = end + 2
+
+def parse_paragraphs(buf, case_sensitive=False, encoding='utf-8', start=0, end=None):
+    '''
+    Parses the paragraphs of *buf* one after the other.
+
+    :param buf: The data as :class:`bytes`, :class:`bytearray`,
+                :class:`mmap.mmap` or :class:`str`.
+    :param case_sensitive: See :attr:`DpkgParagraph.case_sensitive`.
+    :param encoding: Used to decode binary data.
+    :param start: Offset of the data in *buf*.
+    :param end: End offset of the data, defaults to the end of *buf*.
+    :returns: Iterator of :class:`DpkgParagraph` objects.
+    '''
+    if end is None:
+        end = len(buf)
+    for text in _chunks(buf, start, end, encoding):
+        for paragraph in text.split('\n\n'):
+            p = DpkgParagraph(None)
+            p.case_sensitive = case_sensitive
+            p._load_lines(paragraph.split('\n'))
+            if p:
+                yield p
+
+#: The name of a field at the start of a line of a paragraph: anything up
+#: to the first colon of a line not starting with a space.
+_field_name_re = re.compile(rb'^([^ \n:][^:\n]*):', re.M)
+
+#: The newline ending a value: one not followed by a continuation line
+_value_end_re = re.compile(rb'\n(?! )')
+
+@functools.lru_cache(maxsize=64)
+def _field_re(name, encoding):
+    '''
+    Returns the pattern matching the field *name* at the start of a line.
+    '''
+    return re.compile(b'^' + re.escape(name.encode(encoding)) + b':', re.M | re.I)
+
+class LazyParagraph(Mapping):
+    '''
+    A read only paragraph which only stores its position in *buf*. A field
+    is looked up and decoded on each access, so holding many of them
+    costs little more memory than the raw data.
+
+    Field names are case insensitive. If a field occurs twice, the first
+    one spelled like the key is used, or else the first one.
+
+    :param buf: :class:`bytes` or :class:`mmap.mmap`. It must stay open as
+                long as the paragraph is used.
+    :param start: Offset of the paragraph.
+    :param end: Offset after the newline of its last line.
+    :param encoding: Used to decode the values.
+    '''
+    __slots__ = ('_buf', 'start', 'end', 'encoding')
+
+    def __init__(self, buf, start, end, encoding='utf-8'):
+        self._buf = buf
+        self.start = start
+        self.end = end
+        self.encoding = encoding
+
+    def _find(self, key):
+        '''
+        Returns the offsets of the value of the field *key* or
+        :const:`None`.
+        '''
+        buf = self._buf
+        # try the spelling of *key* with find(), which is much faster than
+        # a case insensitive search
+        spelling = key.encode(self.encoding) + b':'
+        if buf[self.start:self.start + len(spelling)] == spelling:
+            pos = self.start + len(spelling)
+        else:
+            pos = buf.find(b'\n' + spelling, self.start, self.end)
+            if pos != -1:
+                pos += 1 + len(spelling)
+        if pos == -1:
+            m = _field_re(key.lower(), self.encoding).search(buf, self.start, self.end)
+            if m is None:
+                return None
+            pos = m.end()
+        end = _value_end_re.search(buf, pos, self.end)
+        return pos, self.end if end is None else end.start()
+
+    def __getitem__(self, key):
+        span = self._find(key)
+        if span is None:
+            raise KeyError(key)
+        value = self._buf[span[0]:span[1]].decode(self.encoding).rstrip('\n')
+        if '\n ' in value:
+            value = value.split('\n ')
+            value[0] = value[0].strip()
+            return value
+        return value.strip()
+
+    def __contains__(self, key):
+        return not self._find(key) is None
+
+    def paragraph(self):
+        '''
+        Parses all fields into a :class:`DpkgParagraph`.
+        '''
+        p = DpkgParagraph(None)
+        p._load_lines(self.text().split('\n'))
+        return p
+
+    def __iter__(self):
+        seen = set()
+        for m in _field_name_re.finditer(self._buf, self.start, self.end):
+            name = m.group(1).decode(self.encoding).lower()
+            if not name in seen:
+                seen.add(name)
+                yield name
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def raw(self):
+        '''
+        The paragraph as it is in the buffer.
+        '''
+        return bytes(self._buf[self.start:self.end])
+
+    def text(self):
+        return self.raw().decode(self.encoding)
+
+def iter_lazy_paragraphs(buf, encoding='utf-8', start=0, end=None):
+    '''
+    Iterates over the paragraphs of *buf* without parsing them.
+
+    :param buf: :class:`bytes` or :class:`mmap.mmap`.
+    :param start: See :func:`parse_paragraphs`.
+    :param end: See :func:`parse_paragraphs`.
+    :returns: Iterator of :class:`LazyParagraph` objects.
+    '''
+    for start, end in _paragraph_spans(buf, start, end):
+        yield LazyParagraph(buf, start, end, encoding)
 
 class DpkgParagraph(DpkgOrderedDatalist):
     
@@ -102,6 +298,55 @@ class DpkgParagraph(DpkgOrderedDatalist):
 
             self[key] = value
 
+    def _load_lines(self, lines):
+        '''
+        Stores the fields of a paragraph given as list of lines without
+        their newlines, like :meth:`load` does.
+        '''
+        fields = []
+        casing = self.trueFieldCasing
+        case_sensitive = self.case_sensitive
+        for line in lines:
+            if not line:
+                continue
+            if line[0] == ' ':
+                if not fields:
+                    raise ValueError('Continuation line at the start of a control paragraph')
+                value = fields[-1][1]
+                if not isinstance(value, list):
+                    value = fields[-1][1] = [value]
+                value.append(line[1:])
+                continue
+            key, sep, value = line.partition(':')
+            if not sep:
+                raise ValueError('Invalid line in control paragraph: %r' % (line,))
+            if not case_sensitive:
+                newkey = key.lower()
+                # FIXME: same check as in load()
+                if not key in casing:
+                    casing[newkey] = key
+                key = newkey
+            fields.append([key, value.strip()])
+        self.update(fields)
+
+    def load_buffer(self, buf, encoding='utf-8', start=0, end=None):
+        '''
+        Read the first paragraph of *buf*. Same as :meth:`load`, but
+        without reading line by line.
+
+        :param buf: :class:`bytes`, :class:`bytearray`, :class:`mmap.mmap`
+                    or :class:`str`.
+        :param start: Offset of the data in *buf*, e.g. the start of the
+                      signed text of a :class:`SignedFile` in buffer mode.
+        :param end: End offset of the data, defaults to the end of *buf*.
+        '''
+        for start, end in _paragraph_spans(buf, start, end):
+            text = buf[start:end]
+            if not isinstance(text, str):
+                text = text.decode(encoding)
+            self._load_lines(text.split('\n'))
+            return
+
     def _storeField(self, f, value, lead=''):
         '''
         :param f: File handle
@@ -120,12 +365,12 @@ class DpkgParagraph(DpkgOrderedDatalist):
         Write our paragraph data to a file object
 
         :param f: File handle
-        ''''
+        '''
         for key, value in self.items():
             if key in self.trueFieldCasing:
                 key = self.trueFieldCasing[key]
             f.write(str(key) + ":" )
-            self._storeField(f, value)
+            self._storeField(f, value, ' ')
 
 class DpkgControl(DpkgOrderedDatalist):
 
@@ -156,6 +401,25 @@ class DpkgControl(DpkgOrderedDatalist):
                 break
             self[p[self.key]] = p
 
+    def load_buffer(self, buf, encoding='utf-8', start=0, end=None):
+        '''
+        Read all paragraphs of *buf* (see :func:`parse_paragraphs`).
+        '''
+        for p in parse_paragraphs(buf, self.case_sensitive, encoding, start, end):
+            if p:
+                self[p[self.key]] = p
+
+    def load_file(self, filename):
+        '''
+        Read all paragraphs of the (unsigned) file *filename*. The file is
+        mapped into memory instead of read line by line.
+        '''
+        with open(filename, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                self.load_buffer(buf)
+
     def _store( self, f ):
         "Write our control data to a file object"
 
@@ -21,9 +21,7 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 import os, sys
-from UserDict import UserDict
-from OrderedDict import OrderedDict
-from minidinstall.SafeWriteFile import SafeWriteFile
+from collections import UserDict, OrderedDict
 
 class DpkgDatalistException(Exception):
     UNKNOWN     = 0
@@ -52,7 +50,7 @@ class _DpkgDatalist:
 
         if type(fn) == str:
             # Write to a temporary file first
-            vf = SafeWriteFile(fn+".new", fn, "w")
+            vf = open(fn+".new", "w")
         else:
             # use filename as a file handle
             vf = fn
@@ -61,6 +59,8 @@ class _DpkgDatalist:
         finally:
             if type(fn) == str:
                 vf.close()
+        if type(fn) == str:
+            os.rename(fn+".new", fn)
 
 
 class DpkgDatalist(UserDict, _DpkgDatalist):
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# GPGSigVerifier -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+Verification of clearsigned files with gpgv.
+
+A verifier only caches results; it doesn't keep a gpgv process. gpgv
+checks a single signature per run and has no batch mode, so every
+content not checked before still costs one gpgv run. The verifier
+object lives as long as the daemon. The result of each check is cached
+by the SHA256 of the checked content and the mtime and size of the
+keyrings. So an upload which is retried or installed into several
+distributions is only passed to gpgv once. Use :func:`get_verifier` to
+share the verifiers and their caches between the archive threads.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import hashlib
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+
+#: Keyrings used by :class:`DebianSigVerifier` if none are configured.
+DEFAULT_KEYRINGS = ('/usr/share/keyrings/debian-keyring.gpg',
+                    '/usr/share/keyrings/debian-keyring.pgp')
+
+class GPGSigVerifierException(Exception):
+
+    def __init__(self, value):
+        self._value = value
+
+    def __str__(self):
+        return str(self._value)
+
+class GPGSigVerificationFailure(Exception):
+    '''
+    The signature is missing, bad or made by an unknown key.
+    '''
+
+    def __init__(self, value, output):
+        self._value = value
+        self._output = output
+
+    def __str__(self):
+        return str(self._value)
+
+    def getOutput(self):
+        '''
+        :returns: The output of gpgv as list of lines.
+        '''
+        return self._output
+
+class GPGSigVerifier(object):
+    '''
+    Checks signatures with gpgv and caches the results.
+
+    :param keyrings: List of keyring files. Missing files are ignored.
+    :param gpgv: The gpgv binary.
+    :param cache_size: Number of results to remember.
+    '''
+
+    def __init__(self, keyrings, gpgv='gpgv', cache_size=256):
+        self._keyrings = list(keyrings)
+        self._gpgv = gpgv
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        #: (path, mtime_ns, size) of each existing keyring
+        self._keyring_state = None
+        #: (keyring state, sha256 of the content) => (good, output)
+        self._results = OrderedDict()
+
+    def _current_keyrings(self):
+        '''
+        Compares the keyrings with the state of the last check and drops
+        the cached results if any of them changed.
+
+        :returns: Tuple of the keyring state and the list of the existing
+                  keyrings.
+        '''
+        state = []
+        for keyring in self._keyrings:
+            try:
+                st = os.stat(keyring)
+            except OSError:
+                continue
+            state.append((keyring, st.st_mtime_ns, st.st_size))
+        state = tuple(state)
+        with self._lock:
+            if state != self._keyring_state:
+                self._keyring_state = state
+                self._results.clear()
+        if not state:
+            raise GPGSigVerifierException('No keyring available: %s' % ', '.join(self._keyrings))
+        return state, [keyring for keyring, mtime, size in state]
+
+    def _run_gpgv(self, keyrings, data):
+        '''
+        Runs gpgv once for *data*.
+        '''
+        args = [self._gpgv]
+        for keyring in keyrings:
+            args.extend(('--keyring', keyring))
+        args.append('-')
+        try:
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise GPGSigVerifierException('Failed to run %s: %s' % (self._gpgv, e))
+        output = proc.communicate(data)[0]
+        return proc.returncode == 0, output.decode('utf-8', 'replace').splitlines(True)
+
+    def verify_buffer(self, data, name='<buffer>'):
+        '''
+        Verifies the clearsigned content *data*.
+
+        :param data: :class:`bytes`, or a :class:`memoryview` like
+                     :attr:`SignedFile.SignedFile.raw`.
+        :param name: Used in the error message.
+        :returns: The output of gpgv as list of lines.
+        :raises GPGSigVerificationFailure: if the signature is not good.
+        '''
+        state, keyrings = self._current_keyrings()
+        # the state is part of the key in case the keyrings changed while
+        # gpgv was running
+        key = (state, hashlib.sha256(data).digest())
+        with self._lock:
+            result = self._results.get(key)
+            if not result is None:
+                self._results.move_to_end(key)
+        if result is None:
+            result = self._run_gpgv(keyrings, data)
+            with self._lock:
+                self._results[key] = result
+                while len(self._results) > self._cache_size:
+                    self._results.popitem(last=False)
+        good, output = result
+        if not good:
+            raise GPGSigVerificationFailure('gpgv failed to verify "%s"' % name, output)
+        return output
+
+    def verify(self, filename):
+        '''
+        Same as :meth:`verify_buffer` for the file *filename*.
+        '''
+        with open(filename, 'rb') as f:
+            return self.verify_buffer(f.read(), filename)
+
+class DebianSigVerifier(GPGSigVerifier):
+    '''
+    Verifier using the given *keyrings* or the Debian keyrings plus
+    *extra_keyrings*. The local keyring of dpkg is always added.
+    '''
+    _dpkg_ring = '/etc/dpkg/local-keyring.gpg'
+
+    def __init__(self, keyrings=None, extra_keyrings=None, **kwargs):
+        if keyrings is None:
+            keyrings = list(DEFAULT_KEYRINGS)
+        else:
+            keyrings = list(keyrings)
+        keyrings.append(self._dpkg_ring)
+        if not extra_keyrings is None:
+            keyrings.extend(extra_keyrings)
+        GPGSigVerifier.__init__(self, keyrings, **kwargs)
+
+_verifiers = {}
+_verifiers_lock = threading.Lock()
+
+def get_verifier(keyrings=None, extra_keyrings=None):
+    '''
+    Returns the shared :class:`DebianSigVerifier` for the given keyrings,
+    creating it on first use.
+    '''
+    if not keyrings is None:
+        keyrings = tuple(keyrings)
+    if not extra_keyrings is None:
+        extra_keyrings = tuple(extra_keyrings)
+    key = (keyrings, extra_keyrings)
+    with _verifiers_lock:
+        verifier = _verifiers.get(key)
+        if verifier is None:
+            verifier = DebianSigVerifier(keyrings=keyrings, extra_keyrings=extra_keyrings)
+            _verifiers[key] = verifier
+        return verifier
@@ -2,6 +2,11 @@
 '''
 SignedFile offers a subset of file object operations, and is
 designed to transparently handle files with PGP signatures.
+
+SignedFile.from_file and SignedFile.from_buffer read the whole file at
+once and find the armor in a single pass. The signed text and the
+complete file are then available as memoryviews, so the parser and the
+signature check can use them without copying.
 '''
 # Copyright © 2002 Colin Walters <walters@gnu.org>
 #
@@ -19,8 +24,16 @@ designed to transparently handle files with PGP signatures.
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+import io
 import re,string
 
+ARMOR_SIGNED = b'-----BEGIN PGP SIGNED MESSAGE-----\n'
+ARMOR_SIGNATURE = b'-----BEGIN PGP SIGNATURE-----\n'
+ARMOR_END = b'-----END PGP SIGNATURE-----'
+
+#: Prefix of a dash-escaped line of signed text
+_dash_escape_re = re.compile(rb'^- ', re.M)
+
 class SignedFile(object):
     #: The file handle
     _stream = None
@@ -29,6 +42,14 @@ class SignedFile(object):
     _signature = None
     _signatureversion = None
     _initline = None
+    #: The buffer holding the signed text in buffer mode
+    buffer = None
+    #: Offsets of the signed text in :attr:`buffer`
+    body_start = 0
+    body_end = 0
+    _lines = None
+    #: The complete content in buffer mode
+    _raw = None
 
     def __init__(self, stream):
         self._stream = stream
@@ -40,7 +61,80 @@ class SignedFile(object):
         else:
             self._initline = line
 
+    @classmethod
+    def from_buffer(cls, data):
+        '''
+        Buffer mode: parses the complete content *data* (:class:`bytes` or
+        :class:`mmap.mmap`) at once instead of line by line.
+
+        Dash-escaped text is copied with the escapes removed; otherwise
+        :attr:`buffer` is *data* itself.
+        '''
+        self = cls.__new__(cls)
+        self.buffer = self._raw = data
+        start = 0
+        end = len(data)
+        if data[:len(ARMOR_SIGNED)] == ARMOR_SIGNED:
+            self._signed = True
+            # the armor headers end with the first blank line
+            start = data.find(b'\n\n', len(ARMOR_SIGNED) - 1)
+            start = end if start == -1 else start + 2
+            armor = data.find(b'\n' + ARMOR_SIGNATURE, start - 1)
+            if armor != -1:
+                self._parse_signature(data, armor + 1 + len(ARMOR_SIGNATURE))
+                end = armor + 1
+            if data[start:start + 2] == b'- ' or data.find(b'\n- ', start, end) != -1:
+                self.buffer = _dash_escape_re.sub(b'', bytes(data[start:end]))
+                start, end = 0, len(self.buffer)
+        self.body_start = start
+        self.body_end = end
+        return self
+
+    @classmethod
+    def from_file(cls, filename):
+        '''
+        Buffer mode for the file *filename*, which is read with a single
+        call.
+        '''
+        with open(filename, 'rb') as f:
+            return cls.from_buffer(f.read())
+
+    def _parse_signature(self, data, pos):
+        end = data.find(ARMOR_END, pos)
+        if end == -1:
+            end = len(data)
+        text = bytes(data[pos:end]).decode('ascii', 'replace')
+        if text.startswith('\n'):
+            # no armor headers
+            headers, signature = '', text[1:]
+        else:
+            headers, sep, signature = text.partition('\n\n')
+        for line in headers.split('\n'):
+            if ':' in line:
+                self._signatureversion = line.split(':', 1)[1].strip()
+                break
+        self._signature = signature
+
+    @property
+    def body(self):
+        '''
+        The signed text as memoryview (buffer mode only).
+        '''
+        return memoryview(self.buffer)[self.body_start:self.body_end]
+
+    @property
+    def raw(self):
+        '''
+        The complete file as memoryview (buffer mode only), e.g. to
+        verify the signature.
+        '''
+        return memoryview(self._raw)
+
     def readline(self):
+        if not self.buffer is None:
+            if self._lines is None:
+                self._lines = io.StringIO(str(self.body, 'utf-8'))
+            return self._lines.readline()
         if self._eof:
             return ''
         if self._initline:
@@ -65,6 +159,9 @@ class SignedFile(object):
                 self._signature.append(line)
             self._signature = ''.join(self._signature)
             return ''
+        elif line.startswith('- '):
+            # dash-escaped
+            return line[2:]
         return line
 
     def readlines(self):
@@ -78,7 +175,8 @@ class SignedFile(object):
         return ret
 
     def close(self):
-        self._stream.close()
+        if not self._stream is None:
+            self._stream.close()
 
     def getSigned(self):
         return self._signed
@@ -136,6 +234,27 @@ fBUDSfrkYXPt+57IIhgNE07na4Wz+hXK22M4RH3RsHRBdvU9M/g+Et17LUCf3eM=
 =Nc23
 ''')
 
+        def test_read_signed_buffer(self):
+            with open(self.signed,'r') as infile:
+                f = SignedFile(infile)
+                lines = f.readlines()
+            g = SignedFile.from_file(self.signed)
+            self.assertTrue(g.signed)
+            self.assertEqual(bytes(g.body), ''.join(lines).encode())
+            self.assertEqual(g.readlines(), lines)
+            self.assertEqual(g.singature_version, f.singature_version)
+            self.assertEqual(g.signature, f.signature)
+
+        def test_dash_escaped(self):
+            with open(self.signed, 'rb') as infile:
+                data = infile.read()
+            data = data.replace(b'\n\n', b'\n\n- -- escaped\n', 1)
+            g = SignedFile.from_buffer(data)
+            f = SignedFile(io.StringIO(data.decode()))
+            self.assertEqual(g.readlines(), f.readlines())
+            self.assertTrue(bytes(g.body).startswith(b'-- escaped\n'))
+            self.assertEqual(bytes(g.raw), data)
+
     unittest.main()
 
 
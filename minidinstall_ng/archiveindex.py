@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# archiveindex -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+In-memory index of the package files of an archive directory.
+
+The files are classified once by their names. Finding the files an upload
+replaces then only needs dictionary lookups instead of listing and
+matching whole directories for every new file.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import os
+import re
+
+_name = r'([-+a-zA-Z0-9._]+)'
+_version = r'([-+:.~a-zA-Z0-9]+)'
+_tar = r'\.tar\.(?:gz|bz2|lzma|xz)'
+
+debpackage_re = re.compile(_name + '_' + _version + r'_([-a-zA-Z0-9]+)\.u?deb$')
+debchanges_re = re.compile(_name + '_' + _version + r'_([-a-zA-Z0-9]+)\.changes$')
+debsrc_dsc_re = re.compile(_name + '_' + _version + r'\.dsc$')
+debsrc_diff_re = re.compile(_name + '_' + _version + r'\.(?:diff\.gz|debian' + _tar + ')$')
+debsrc_orig_re = re.compile(_name + '_' + _version + r'\.orig(?:-[a-zA-Z0-9-]+)?' + _tar + '$')
+debsrc_native_re = re.compile(_name + '_' + _version + _tar + '$')
+
+#: Kinds of source files, in the order they are tried.
+SOURCE_KINDS = (('changes', debchanges_re),
+                ('dsc', debsrc_dsc_re),
+                ('diff', debsrc_diff_re),
+                ('orig', debsrc_orig_re),
+                ('native', debsrc_native_re))
+
+def classify_source(name):
+    '''
+    :returns: Tuple of the kind (see :data:`SOURCE_KINDS`), the package name
+              and the version or :const:`None` if *name* is no source file.
+    '''
+    for kind, regex in SOURCE_KINDS:
+        match = regex.search(name)
+        if match:
+            return kind, match.group(1), match.group(2)
+    return None
+
+class ArchiveFileIndex(object):
+    '''
+    The binary and source files of an archive directory.
+
+    Directories are remembered with their mtime; :meth:`is_current` tells
+    whether something else changed them since the index was built or last
+    updated with :meth:`touch`.
+    '''
+
+    def __init__(self):
+        #: (package, arch) => {path: version}
+        self.binaries = {}
+        #: package => {path: (kind, version)}
+        self.sources = {}
+        #: path => key in :attr:`binaries` or :attr:`sources`
+        self._paths = {}
+        #: path => SHA256 of the files whose checksum is known
+        self.digests = {}
+        #: directory => mtime_ns
+        self._dirs = {}
+
+    def add_binary(self, path, arch=None, sha256=None):
+        '''
+        Adds the package *path*, unless it is no binary package or isn't
+        built for *arch*.
+
+        :param sha256: The SHA256 of the file if known, e.g. from the
+                       .changes file it was installed with.
+        '''
+        match = debpackage_re.search(os.path.basename(path))
+        if not match or not arch in (None, match.group(3)):
+            return False
+        self.remove(path)
+        key = (match.group(1), match.group(3))
+        self.binaries.setdefault(key, {})[path] = match.group(2)
+        self._paths[path] = (self.binaries, key)
+        if not sha256 is None:
+            self.digests[path] = sha256
+        return True
+
+    def add_source(self, path, sha256=None):
+        info = classify_source(os.path.basename(path))
+        if info is None:
+            return False
+        self.remove(path)
+        kind, name, version = info
+        self.sources.setdefault(name, {})[path] = (kind, version)
+        self._paths[path] = (self.sources, name)
+        if not sha256 is None:
+            self.digests[path] = sha256
+        return True
+
+    def remove(self, path):
+        self.digests.pop(path, None)
+        entry = self._paths.pop(path, None)
+        if entry is None:
+            return
+        table, key = entry
+        files = table[key]
+        del files[path]
+        if not files:
+            del table[key]
+
+    def __contains__(self, path):
+        return path in self._paths
+
+    def get_binaries(self, package, arch):
+        '''
+        :returns: Dictionary mapping the paths of *package* built for *arch*
+                  to their versions.
+        '''
+        return self.binaries.get((package, arch), {})
+
+    def get_sources(self, package):
+        '''
+        :returns: Dictionary mapping the paths of the source files (and
+                  .changes) of *package* to (kind, version) tuples.
+        '''
+        return self.sources.get(package, {})
+
+    def package_versions(self):
+        '''
+        :returns: List of (package, version, arch) tuples of all binaries.
+        '''
+        return [(package, version, arch)
+                for (package, arch), files in self.binaries.items()
+                for version in files.values()]
+
+    def touch(self, dirs=None):
+        '''
+        Remembers the current mtime of *dirs*, by default of all
+        directories known so far.
+        '''
+        if dirs is None:
+            dirs = list(self._dirs)
+        for dir in dirs:
+            self._dirs[dir] = os.stat(dir).st_mtime_ns
+
+    def is_current(self):
+        for dir, mtime_ns in self._dirs.items():
+            try:
+                if os.stat(dir).st_mtime_ns != mtime_ns:
+                    return False
+            except OSError:
+                return False
+        return True
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class TestArchiveFileIndex(unittest.TestCase):
+        def test_classify(self):
+            self.assertEqual(classify_source('foo_1.0-1.debian.tar.xz'), ('diff', 'foo', '1.0-1'))
+            self.assertEqual(classify_source('foo_1.0.orig.tar.gz'), ('orig', 'foo', '1.0'))
+            self.assertEqual(classify_source('foo_1.0.tar.gz'), ('native', 'foo', '1.0'))
+            self.assertEqual(classify_source('foo_1.0_amd64.changes'), ('changes', 'foo', '1.0'))
+            self.assertIsNone(classify_source('foo_1.0_amd64.deb'))
+
+        def test_index(self):
+            index = ArchiveFileIndex()
+            self.assertTrue(index.add_binary('/a/foo_1.0_amd64.deb'))
+            self.assertTrue(index.add_binary('/a/foo_1.1_amd64.deb'))
+            self.assertFalse(index.add_binary('/a/foo_1.1.dsc'))
+            self.assertFalse(index.add_binary('/a/foo_1.1_all.deb', 'amd64'))
+            self.assertTrue(index.add_source('/a/foo_1.1.dsc'))
+            self.assertEqual(index.get_binaries('foo', 'amd64'),
+                             {'/a/foo_1.0_amd64.deb': '1.0', '/a/foo_1.1_amd64.deb': '1.1'})
+            index.remove('/a/foo_1.0_amd64.deb')
+            self.assertEqual(index.package_versions(), [('foo', '1.1', 'amd64')])
+            self.assertEqual(index.get_sources('foo'), {'/a/foo_1.1.dsc': ('dsc', '1.1')})
+            index.remove('/a/foo_1.1.dsc')
+            self.assertEqual(index.sources, {})
+
+    unittest.main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# blobstore -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+Content addressed storage shared by all distributions.
+
+Every installed file is stored once as ``<sha256[:2]>/<sha256>`` and the
+distributions get hardlinks to it. Installing the same package into
+several distributions therefore needs the disk space only once, and as
+all links share one inode the metadata cache knows its checksums after
+the first distribution indexed it.
+
+A blob whose link count dropped to one isn't used by any distribution
+anymore and is removed.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import errno
+import os
+import shutil
+import tempfile
+import threading
+
+from minidinstall_ng import hasher
+from minidinstall_ng.transaction import copy_file, stage_file
+
+class BlobStore(object):
+    '''
+    :param directory: The directory of the store. It is created if
+                      needed and has to be on the same filesystem as the
+                      archive, else the files are copied.
+
+    The install threads of all distributions share one store, see
+    :func:`get_blob_store`. Adding and linking a blob, releasing it and
+    removing unused blobs happen under :attr:`lock`, so no blob is removed
+    between being found and being linked.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.RLock()
+        #: inode => SHA256 of the blobs, read on first use
+        self._inodes = None
+
+    def path(self, sha256):
+        '''
+        Where the blob with the content hash *sha256* is stored.
+        '''
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def _copy(self, filename, blob):
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(blob))
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                copy_file(filename, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            shutil.copystat(filename, tmp)
+            # never replace an existing blob, other links may point to it
+            try:
+                os.link(tmp, blob)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        finally:
+            os.unlink(tmp)
+
+    def _add(self, filename, sha256):
+        blob = self.path(sha256)
+        if os.path.exists(blob):
+            return blob
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(filename, blob)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return blob
+            if not e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            self._copy(filename, blob)
+        if not self._inodes is None:
+            self._inodes[os.stat(blob).st_ino] = sha256
+        return blob
+
+    def add(self, filename, sha256=None):
+        '''
+        Stores the content of *filename* unless there is a blob with the same
+        content already.
+
+        :param sha256: The known SHA256 of the file, e.g. from a verified
+                       .changes file. It is computed if not given.
+        :returns: The path of the blob.
+        '''
+        if sha256 is None:
+            sha256 = hasher.hash_file(filename, 'sha256')
+        with self.lock:
+            return self._add(filename, sha256)
+
+    def stage(self, filename, sha256, target):
+        '''
+        Stores *filename* like :meth:`add` and links the blob to *target*.
+
+        :returns: Like :func:`minidinstall_ng.transaction.stage_file`.
+        '''
+        with self.lock:
+            return stage_file(self._add(filename, sha256), target)
+
+    def _find(self, st):
+        '''
+        The SHA256 of the blob with the inode of *st* or :const:`None`.
+        '''
+        if self._inodes is None:
+            self._inodes = {}
+            for prefix in os.listdir(self.directory):
+                directory = os.path.join(self.directory, prefix)
+                if len(prefix) != 2 or not os.path.isdir(directory):
+                    continue
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if len(entry.name) == 64:
+                            self._inodes[entry.inode()] = entry.name
+        return self._inodes.get(st.st_ino)
+
+    def _unlink(self, blob, st):
+        os.unlink(blob)
+        if not self._inodes is None:
+            self._inodes.pop(st.st_ino, None)
+
+    def release(self, filename, sha256=None):
+        '''
+        Called before *filename* is deleted. If it is the last link to a
+        blob besides the blob itself, the blob is removed as well.
+
+        :param sha256: The SHA256 of the file if known. Else the blob is
+                       looked up by its inode.
+        :returns: :const:`True` if the blob was removed.
+        '''
+        with self.lock:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return False
+            if st.st_nlink != 2:
+                return False
+            if sha256 is None:
+                sha256 = self._find(st)
+                if sha256 is None:
+                    return False
+            blob = self.path(sha256)
+            try:
+                if not os.path.samestat(st, os.stat(blob)):
+                    return False
+            except OSError:
+                return False
+            self._unlink(blob, st)
+            return True
+
+    def drop_unused(self, blobs):
+        '''
+        Removes those of *blobs* nothing links to, e.g. after an installation
+        was rolled back.
+        '''
+        with self.lock:
+            for blob in blobs:
+                try:
+                    st = os.stat(blob)
+                    if st.st_nlink == 1:
+                        self._unlink(blob, st)
+                except OSError:
+                    pass
+
+    def collect(self):
+        '''
+        Removes all blobs nothing links to anymore, e.g. left behind by an
+        installation which was interrupted.
+
+        :returns: The number of removed blobs.
+        '''
+        removed = 0
+        with self.lock:
+            for prefix in os.listdir(self.directory):
+                directory = os.path.join(self.directory, prefix)
+                if len(prefix) != 2 or not os.path.isdir(directory):
+                    continue
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        st = entry.stat()
+                        if entry.is_file() and st.st_nlink == 1:
+                            self._unlink(entry.path, st)
+                            removed += 1
+        return removed
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_blob_store(directory):
+    '''
+    :returns: The :class:`BlobStore` of *directory*, shared by all callers
+              so they use the same lock.
+    '''
+    directory = os.path.abspath(directory)
+    with _stores_lock:
+        store = _stores.get(directory)
+        if store is None:
+            store = _stores[directory] = BlobStore(directory)
+        return store
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import unittest
+
+    class TestBlobStore(unittest.TestCase):
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.store = BlobStore(os.path.join(self.dir, 'blobs'))
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _write(self, name, data):
+            filename = os.path.join(self.dir, name)
+            with open(filename, 'w') as f:
+                f.write(data)
+            return filename
+
+        def test_dedup(self):
+            a = self.store.add(self._write('a', 'same'))
+            b = self.store.add(self._write('b', 'same'))
+            self.assertEqual(a, b)
+            self.assertEqual(os.stat(a).st_nlink, 2)
+            os.unlink(os.path.join(self.dir, 'b'))
+            self.assertTrue(self.store.release(os.path.join(self.dir, 'a')))
+            self.assertFalse(os.path.exists(a))
+
+        def test_collect(self):
+            blob = self.store.add(self._write('a', 'data'))
+            self.assertEqual(self.store.collect(), 0)
+            os.unlink(os.path.join(self.dir, 'a'))
+            self.assertEqual(self.store.collect(), 1)
+            self.assertFalse(os.path.exists(blob))
+
+        def test_threads(self):
+            names = [self._write('f%d' % i, 'same') for i in range(8)]
+            sha256 = hasher.hash_file(names[0], 'sha256')
+            errors = []
+            def stage(name):
+                try:
+                    self.store.stage(name, sha256, name + '.staged')
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=stage, args=(name,)) for name in names]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertTrue(os.path.samestat(os.stat(names[0] + '.staged'),
+                                             os.stat(self.store.path(sha256))))
+
+    unittest.main()
@@ -2,7 +2,7 @@
 # compression -*- mode: python; coding: utf-8 -*-
 #-----------------------------------------------------------------------------
 '''
-
+Write the same content into several differently compressed files at once.
 '''
 #-----------------------------------------------------------------------------
 # Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
@@ -24,34 +24,168 @@
 import gzip
 import bz2
 import lzma
+import threading
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+def _open_plain(filename, mode, level):
+	return open(filename, mode)
+
+def _open_gzip(filename, mode, level):
+	return gzip.open(filename, mode, compresslevel=9 if level is None else level)
+
+def _open_bz2(filename, mode, level):
+	return bz2.open(filename, mode, compresslevel=9 if level is None else level)
+
+def _open_xz(filename, mode, level):
+	if 'r' in mode:
+		return lzma.open(filename, mode)
+	return lzma.open(filename, mode, preset=level)
+
+def _open_zstd(filename, mode, level):
+	if 'r' in mode:
+		return zstandard.open(filename, mode)
+	cctx = zstandard.ZstdCompressor(level=3 if level is None else level)
+	return zstandard.open(filename, mode, cctx=cctx)
+
+#: Supported formats. The name is mapped to the file extension and a
+#: function opening a file in this format with a given compression level.
+formats = {
+	'none': ('', _open_plain),
+	'gz': ('.gz', _open_gzip),
+	'bz2': ('.bz2', _open_bz2),
+	'xz': ('.xz', _open_xz)
+}
+if not zstandard is None:
+	formats['zstd'] = ('.zst', _open_zstd)
+
+#: The formats written if nothing else is given.
+default_formats = (('none', None), ('gz', None), ('bz2', None), ('xz', None))
+
+def parse_format(spec):
+	'''
+	Parses a format specification like ``gz``, ``gz:6`` or ``xz:9e``. The
+	level is optional, ``e`` selects the extreme presets of xz.
+
+	:returns: A tuple of the format name and the level (:const:`None` for
+	          the default level of the format).
+	'''
+	name, sep, level = spec.strip().partition(':')
+	if not name in formats:
+		msg = 'unsupported compression %r. Use one of the following: (%s)'
+		raise ValueError(msg % (name, ', '.join(sorted(formats))))
+	if not sep:
+		return name, None
+	extreme = name == 'xz' and level.endswith('e')
+	if extreme:
+		level = level[:-1]
+	level = int(level)
+	if extreme:
+		level |= lzma.PRESET_EXTREME
+	return name, level
+
+class _WriterThread(threading.Thread):
+	'''
+	Writes the chunks put into :attr:`queue` into a single file. A
+	:const:`None` chunk ends the thread.
+	'''
+	def __init__(self, file_, name, queue_size):
+		threading.Thread.__init__(self, name=name)
+		self.daemon = True
+		self.file = file_
+		self.queue = queue.Queue(queue_size)
+		self.error = None
+
+	def run(self):
+		while True:
+			chunk = self.queue.get()
+			if chunk is None:
+				return
+			if self.error is None:
+				try:
+					self.file.write(chunk)
+				except Exception as e:
+					# keep reading so the producer never blocks
+					self.error = e
 
 class MultiCompressedFile(object):
-	filetypes = {
-		'': open,
-		'.gz': gzip.open,
-		'.bz2': bz2.open,
-		'.xz': lzma.open
-	}
+	'''
+	:param filename: The name of the uncompressed file. The compressed
+	                 files get the extensions of their formats.
+	:param mode: The mode to open the files with.
+	:param formats: List of (format name, level) tuples (see
+	                :func:`parse_format`). Defaults to
+	                :data:`default_formats`.
+	:param threaded: Only for writing. Every file gets its own thread
+	                 which is fed by a bounded queue, so the compressors
+	                 run in parallel and the slowest one doesn't hold up
+	                 the others.
+	:param chunk_size: In threaded mode the written content is collected
+	                   until it reaches this size before it is passed on.
+	:param queue_size: Number of chunks each thread may lag behind.
+	'''
 	def __del__(self):
-		for f in self.files:
-			f.close()
+		self.close()
 
-	def __init__(self, filename, mode='r'):
+	def __init__(self, filename, mode='r', formats=None, threaded=False,
+	             chunk_size=256 * 1024, queue_size=8):
 		self.files = []
 		self.filename = filename
 		self.mode = mode
+		self.formats = list(formats or default_formats)
+		self.threaded = threaded and not 'r' in mode
+		self._chunk_size = chunk_size
+		self._queue_size = queue_size
+		self._threads = []
+		self._pending = []
+		self._pending_size = 0
+
+	@property
+	def extensions(self):
+		for name, level in self.formats:
+			yield formats[name][0]
 
 	@property
 	def filenames(self):
-		for ext in self.filetypes:
+		for ext in self.extensions:
 			yield self.filename + ext
 
 	def __enter__(self):
-		for ext, type_ in self.filetypes.items():
-			self.files.append(type_(self.filename+ext, self.mode))
+		for name, level in self.formats:
+			ext, open_ = formats[name]
+			self.files.append(open_(self.filename+ext, self.mode, level))
+		if self.threaded:
+			for filename, f in zip(self.filenames, self.files):
+				thread = _WriterThread(f, 'compress ' + filename, self._queue_size)
+				thread.start()
+				self._threads.append(thread)
 		return self
 
+	def _dispatch(self, chunk):
+		for thread in self._threads:
+			if not thread.error is None:
+				raise thread.error
+			thread.queue.put(chunk)
+
+	def _flush_pending(self):
+		if self._pending:
+			self._dispatch(self._pending[0][:0].join(self._pending))
+			self._pending = []
+			self._pending_size = 0
+
 	def write(self, content):
+		if self.threaded:
+			self._pending.append(content)
+			self._pending_size += len(content)
+			if self._pending_size >= self._chunk_size:
+				self._flush_pending()
+			return
 		for f in self.files:
 			f.write(content)
 
@@ -62,9 +196,27 @@ class MultiCompressedFile(object):
 				raise RuntimeError('Different content not supported')
 		return result
 
-	def __exit__(self, type, value, tb):
+	def close(self):
+		error = None
+		if self._threads:
+			try:
+				self._flush_pending()
+			finally:
+				for thread in self._threads:
+					thread.queue.put(None)
+				for thread in self._threads:
+					thread.join()
+					if error is None:
+						error = thread.error
+				self._threads = []
 		for f in self.files:
 			f.close()
+		self.files = []
+		if not error is None:
+			raise error
+
+	def __exit__(self, type, value, tb):
+		self.close()
 
 if __name__ == '__main__':
 	import unittest, os, random
@@ -83,4 +235,28 @@ if __name__ == '__main__':
 				self.assertEqual(f.read(), 'there')
 			for f in f.filenames:
 				os.unlink(f)
+
+		def test_threaded_write(self):
+			content = ''.join(random.choice('abc\n') for i in range(100000))
+			with MultiCompressedFile('test2', 'wt', threaded=True, chunk_size=4096) as f:
+				for i in range(0, len(content), 1000):
+					f.write(content[i:i+1000])
+			for filename, (name, level) in zip(f.filenames, f.formats):
+				with formats[name][1](filename, 'rt', None) as infile:
+					self.assertEqual(infile.read(), content)
+				os.unlink(filename)
+
+		def test_formats(self):
+			self.assertEqual(parse_format('gz'), ('gz', None))
+			self.assertEqual(parse_format(' gz:1 '), ('gz', 1))
+			self.assertEqual(parse_format('xz:9e'), ('xz', 9 | lzma.PRESET_EXTREME))
+			self.assertRaises(ValueError, parse_format, 'rar')
+			with MultiCompressedFile('test3', 'wt', formats=[('none', None), ('xz', 0)]) as f:
+				f.write('hi there')
+			self.assertEqual(list(f.filenames), ['test3', 'test3.xz'])
+			self.assertFalse(os.path.isfile('test3.gz'))
+			with MultiCompressedFile('test3', 'rt', formats=f.formats) as f:
+				self.assertEqual(f.read(), 'hi there')
+			for filename in f.filenames:
+				os.unlink(filename)
 	unittest.main()
\ No newline at end of file
@@ -1,4 +1,6 @@
 import logging
+import os
+from minidinstall_ng import compression
 
 class StrList:
     '''
@@ -17,7 +19,7 @@ class StrList:
         if self._strip:
             value = map(str.strip, value)
         if not self._type is None:
-            value = map(self._type)
+            value = map(self._type, value)
         return list(value)
 
 def path(value):
@@ -26,6 +28,9 @@ def path(value):
 # string list with default configuration
 str_list = StrList()
 
+# list of compression formats like "none, gz:9, xz:6e"
+compression_list = StrList(type=compression.parse_format)
+
 class IntWithBase:
     def __init__(self, base):
         self._base = base
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# debversion -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+Debian version numbers.
+
+A version string is split into epoch, upstream version and revision once
+and turned into a key which sorts like dpkg does. Parsed versions are
+cached, so comparing the same strings again costs a dictionary lookup and
+lists of versions can be sorted with ``sorted(versions, key=version_key)``.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import functools
+import re
+
+_part_re = re.compile(r'([^0-9]*)([0-9]*)')
+
+#: Marks the end of a version part; sorts after "~" and before everything
+#: else, like the end of the string in dpkg's comparison.
+_END = ((0,), 0)
+
+def _order(c):
+    if c == '~':
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+def _part_key(s):
+    '''
+    Sort key of an upstream version or revision: a tuple of (non-digit
+    part, number) pairs. The non-digit parts are tuples of character
+    weights ending with 0.
+    '''
+    key = []
+    for alpha, digits in _part_re.findall(s):
+        if not alpha and not digits:
+            continue
+        key.append((tuple(_order(c) for c in alpha) + (0,), int(digits or 0)))
+    # a trailing 0 compares equal to the end of the string
+    while key and key[-1] == _END:
+        key.pop()
+    key.append(_END)
+    return tuple(key)
+
+@functools.total_ordering
+class DebianVersion(object):
+    '''
+    A parsed version. Instances compare like dpkg compares versions; use
+    :func:`parse_version` to get cached instances.
+
+    :param version: The version string.
+    '''
+    __slots__ = ('version', 'epoch', 'upstream', 'revision', 'upstream_key', 'key')
+
+    def __init__(self, version):
+        self.version = version
+        epoch, sep, rest = version.partition(':')
+        if sep and epoch.isdigit():
+            self.epoch = int(epoch)
+        else:
+            self.epoch = 0
+            rest = version
+        upstream, sep, revision = rest.rpartition('-')
+        if sep:
+            self.upstream = upstream
+            self.revision = revision
+        else:
+            self.upstream = rest
+            #: :const:`None` for native packages
+            self.revision = None
+        self.upstream_key = _part_key(self.upstream)
+        self.key = (self.epoch, self.upstream_key, _part_key(self.revision or ''))
+
+    @property
+    def is_native(self):
+        return self.revision is None
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            other = parse_version(other)
+        return self.key == other.key
+
+    def __lt__(self, other):
+        if isinstance(other, str):
+            other = parse_version(other)
+        return self.key < other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return self.version
+
+    def __repr__(self):
+        return 'DebianVersion(%r)' % self.version
+
+@functools.lru_cache(maxsize=4096)
+def parse_version(version):
+    '''
+    :returns: The (cached) :class:`DebianVersion` of the string *version*.
+    '''
+    return DebianVersion(version)
+
+def version_key(version):
+    '''
+    Sort key of the string *version*, e.g. for :func:`sorted`.
+    '''
+    return parse_version(version).key
+
+@functools.lru_cache(maxsize=4096)
+def upstream_key(upstream):
+    '''
+    Sort key of the upstream version *upstream* alone, e.g. taken from the
+    name of an orig tarball. Unlike :func:`parse_version` it is never split
+    at a "-", which may be part of an upstream version.
+    '''
+    return _part_key(upstream)
+
+def version_compare(a, b):
+    '''
+    Compares the version strings *a* and *b* like
+    ``apt_pkg.version_compare``.
+
+    :returns: A negative number if *a* is older than *b*, 0 if both are the
+              same and a positive number if *a* is newer.
+    '''
+    a = version_key(a)
+    b = version_key(b)
+    return (a > b) - (a < b)
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class TestDebianVersion(unittest.TestCase):
+        def test_compare(self):
+            for a, b in (('1.0', '1.1'), ('1.0~rc1', '1.0'), ('1.0', '1.0.0'),
+                         ('1.0-1', '1.0-1+b1'), ('1.0-1', '1:0.9'), ('1.9', '1.10'),
+                         ('1.0a', '1.0+'), ('1.0~~', '1.0~'), ('1.0-1~bpo1', '1.0-1')):
+                self.assertLess(version_compare(a, b), 0, (a, b))
+                self.assertGreater(version_compare(b, a), 0, (a, b))
+            for a, b in (('1.0', '1.00'), ('0:1.0', '1.0'), ('1.0-0', '1.0'), ('1a', '1a0')):
+                self.assertEqual(version_compare(a, b), 0, (a, b))
+
+        def test_parse(self):
+            v = parse_version('2:1.0-1-3')
+            self.assertEqual((v.epoch, v.upstream, v.revision), (2, '1.0-1', '3'))
+            self.assertTrue(parse_version('1.0').is_native)
+            self.assertEqual(parse_version('2.0-rc1-2').upstream_key, upstream_key('2.0-rc1'))
+            self.assertLess(upstream_key('2.0-rc1'), parse_version('2.0-rc2-1').upstream_key)
+            self.assertIs(parse_version('2:1.0-1-3'), v)
+            self.assertEqual(sorted(['1.0', '1.0~rc1', '0:0.9', '1:0.1'], key=version_key),
+                             ['0:0.9', '1.0~rc1', '1.0', '1:0.1'])
+
+    unittest.main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# dirsnapshot -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+Snapshots of the files in a directory.
+
+Comparing two snapshots tells exactly which files were added, removed or
+modified in between. Unlike the mtime of the directory this also notices
+files replaced within the same second and ignores files nobody is
+interested in.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import os
+from collections import namedtuple
+
+
+class FileState(namedtuple('FileState', ['size', 'mtime_ns', 'ino'])):
+    '''
+    What is remembered of a single file.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_stat(cls, st):
+        return cls(st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class SnapshotDiff(namedtuple('SnapshotDiff', ['added', 'removed', 'modified'])):
+    '''
+    The difference of two snapshots. Each field is a sorted list of
+    filenames. The diff is false if nothing changed.
+    '''
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
+
+    __nonzero__ = __bool__
+
+    @property
+    def changed(self):
+        '''
+        The added and modified files.
+        '''
+        return sorted(self.added + self.modified)
+
+
+class DirectorySnapshot(object):
+    '''
+    The regular files of *directory* with their size, mtime (in
+    nanoseconds) and inode number.
+
+    :param directory: The directory to scan.
+    :param filter: Optional callable which gets a filename and returns
+                   whether the file should be part of the snapshot.
+    '''
+    def __init__(self, directory, filter=None):
+        self.directory = directory
+        self.filter = filter
+        #: filename => :class:`FileState`
+        self.files = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not filter is None and not filter(entry.name):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    self.files[entry.name] = FileState.from_stat(entry.stat())
+                except FileNotFoundError:
+                    # removed while scanning
+                    pass
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def get(self, name):
+        return self.files.get(name)
+
+    def rescan(self):
+        '''
+        Returns a new snapshot of the same directory with the same filter.
+        '''
+        return DirectorySnapshot(self.directory, filter=self.filter)
+
+    def refresh(self, names):
+        '''
+        Updates the entries of the files *names* in place, e.g. after they
+        were changed by ourselves.
+        '''
+        for name in names:
+            if not self.filter is None and not self.filter(name):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                self.files.pop(name, None)
+                continue
+            self.files[name] = FileState.from_stat(st)
+
+    def diff(self, newer):
+        '''
+        Compares this snapshot with the *newer* one.
+
+        :returns: :class:`SnapshotDiff`
+        '''
+        added = []
+        modified = []
+        for name, state in newer.files.items():
+            old = self.files.get(name)
+            if old is None:
+                added.append(name)
+            elif old != state:
+                modified.append(name)
+        removed = [name for name in self.files if not name in newer.files]
+        return SnapshotDiff(sorted(added), sorted(removed), sorted(modified))
+
+
+if __name__ == '__main__':
+    import unittest
+    import shutil
+    import tempfile
+
+    class TestDirectorySnapshot(unittest.TestCase):
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _write(self, name, data):
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(data)
+
+        def test_diff(self):
+            self._write('a.deb', 'a')
+            self._write('b.deb', 'b')
+            self._write('c.deb', 'c')
+            old = DirectorySnapshot(self.dir)
+            self._write('b.deb', 'bb')
+            os.unlink(os.path.join(self.dir, 'c.deb'))
+            self._write('d.deb', 'd')
+            diff = old.diff(old.rescan())
+            self.assertEqual(diff, SnapshotDiff(['d.deb'], ['c.deb'], ['b.deb']))
+            self.assertFalse(old.rescan().diff(old.rescan()))
+
+        def test_filter(self):
+            old = DirectorySnapshot(self.dir, filter=lambda name: name.endswith('.deb'))
+            self._write('foo_1.0.reason', 'rejected')
+            self.assertFalse(old.diff(old.rescan()))
+            self._write('foo_1.0_all.deb', 'x')
+            self.assertEqual(old.diff(old.rescan()).added, ['foo_1.0_all.deb'])
+
+    unittest.main()
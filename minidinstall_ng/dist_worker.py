@@ -1,8 +1,18 @@
 import threading
-import subprocess
+import time
 import minidinstall_ng.hasher as hasher
 import os
-import minidinstall_ng.compression
+import mmap
+from minidinstall_ng import compression
+from minidinstall_ng import packageindex
+from minidinstall_ng import metacache
+from minidinstall_ng import transaction
+from minidinstall_ng import blobstore
+from minidinstall_ng import archiveindex
+from minidinstall_ng import debversion
+from minidinstall_ng.archiveindex import debpackage_re, debchanges_re, debsrc_dsc_re, debsrc_diff_re, debsrc_orig_re, debsrc_native_re
+from minidinstall_ng.Dnotify import DirectoryNotifierFactory, DirectoryNotifierAsyncWrapper, EventCoalescer
+from minidinstall_ng.GPGSigVerifier import get_verifier, GPGSigVerificationFailure, GPGSigVerifierException
 class DirHandler(object):
     
     def _run_script(self, changefilename, script, dir=None):
@@ -28,24 +38,32 @@ class DirHandler(object):
 
 class ArchiveDirIndexer(DirHandler, threading.Thread):
     '''
-    Basically calls apt-ftparchive on the distribution directory to create
-    the "Packages" and "Sources" files.
+    Creates the "Packages" and "Sources" files of the distribution
+    directory. The package data is kept in
+    :class:`minidinstall_ng.packageindex.PackageIndex` objects so each
+    package has to be read only once.
     '''
 
     hashes = [ 'md5', 'sha1', 'sha256' ]
 
-    def __init__(self, dir, logger, config, use_dnotify=0, batch_mode=1):
+    def __init__(self, dir, logger, config, use_dnotify=0, batch_mode=1,
+                 no_act=False, use_inotify=1):
         self.name = os.path.basename(os.path.abspath(dir))
         threading.Thread.__init__(self, name=self.name)
         self.directory = dir
         self.logger = logger
+        self.config = config
         self._eventqueue = Queue.Queue()
         do_mkdir(dir)
         self.use_dnotify = use_dnotify
+        self.use_inotify = use_inotify
         self.batch_mode = batch_mode
+        self.no_act = no_act
         self.wait = self.join
         self._reindex_needed_event = threading.Event()
         self._release_needed_event = threading.Event()
+        #: directory => :class:`minidinstall_ng.packageindex.PackageIndex`
+        self._indices = {}
 
     def _abspath(self, *args):
         return os.path.abspath(os.path.join(self.directory, *args))
@@ -53,34 +71,101 @@ class ArchiveDirIndexer(DirHandler, threading.Thread):
     def _relpath(self, *args):
         return os.path.join(self.name, *args)
 
+    def _get_cache(self, directory):
+        '''
+        The metadata cache of the index of *directory*. With a shared pool
+        all distributions use the one of the pool, so a file installed into
+        several of them is read only once.
+        '''
+        if self.config.shared_pool:
+            return metacache.get_shared_cache(os.path.join(self.config.shared_pool, 'metadata.db'))
+        return metacache.MetadataCache('%s.db' % directory)
+
+    def _get_index(self, directory, typ):
+        index = self._indices.get((directory, typ))
+        if index is None:
+            cache = None
+            if self.config.use_db:
+                cache = self._get_cache(directory)
+            index = packageindex.PackageIndex(directory, typ, self.logger, cache=cache)
+            self._load_indexfile(index)
+            self._indices[(directory, typ)] = index
+        return index
+
+    def _load_indexfile(self, index):
+        '''
+        Seeds *index* with the index file written by the last run (see
+        :meth:`minidinstall_ng.packageindex.PackageIndex.load`).
+        '''
+        filename = os.path.join(index.directory, packageindex.INDEXFILE_NAMES[index.typ])
+        for name, level in self.config.index_compression:
+            ext, opener = compression.formats[name]
+            try:
+                st = os.stat(filename + ext)
+            except OSError:
+                continue
+            try:
+                with opener(filename + ext, 'rb', None) as f:
+                    if not ext and st.st_size:
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                            taken = index.load(buf, st.st_mtime_ns)
+                    else:
+                        taken = index.load(f.read(), st.st_mtime_ns)
+            except Exception as e:
+                self.logger.warning('Can\'t read "%s": %s' % (filename + ext, e))
+                continue
+            self.logger.debug('Took %d entries from "%s"' % (taken, filename + ext))
+            return
+
+    def _index_changed(self, directory, typ):
+        '''
+        Whether the files of the *typ* index of *directory* changed since
+        it was last generated. Uses the snapshot taken by
+        :attr:`reindex_needed`, which the following update works with too.
+        '''
+        return self._get_index(directory, typ).changed(rescan=False)
+
     def _make_indexfile(self, directory, typ, name):
-        # if nodb_mode:
-        cmdline = ['apt-ftparchive', typ, directory]
-        # else:
-        #     cmdline = ['apt-ftparchive', typ, directory, '--db', '%s.db' %directory]
+        index = self._get_index(directory, typ)
+        self.logger.debug('Updating %s index of %s' % (typ, directory))
+        index.update()
+        self._write_indexfile(index, name)
 
-        self.logger.debug("Running: " + string.join(cmdline, ' '))
-        if no_act:
+    def _write_indexfile(self, index, name):
+        if self.no_act:
             return
-        proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE)
-        packagesfilename = os.path.join(directory, name)        
-        
-        with compression.MultiCompressedFile(packagesfilename+'.new', 'wt') as indexfiles
-            for line in iter(proc.stdout.readline, ''):
-                for file_, filename in files:
-                    file_.write(line)
-        out, err = proc.communicate()
-        if out != '':
-            raise RuntimeError('Printed after reading: %r' % out)
-        status = proc.wait()
-        # close all files
-        map(lambda x: x[0].close(), files)
-        if status != 0:
-            raise DinstallException("apt-ftparchive exited with status code %d" % status)
-
-        for filename in indexfiles.filenames:
+        packagesfilename = os.path.join(index.directory, name)
+        with compression.MultiCompressedFile(packagesfilename+'.new', 'wt',
+                                             formats=self.config.index_compression,
+                                             threaded=True) as indexfiles:
+            index.write(indexfiles)
+
+        for ext in indexfiles.extensions:
             # move from file.new to file
-            shutil.move(filename, filename[:-4])
+            os.rename(packagesfilename + '.new' + ext, packagesfilename + ext)
+
+    def _apply_delta(self, delta):
+        '''
+        Splices the files added and removed by a single installation into
+        the affected indices instead of rescanning their directories.
+
+        :param delta: :class:`minidinstall_ng.packageindex.IndexDelta`
+        '''
+        changed = []
+        for index in list(self._indices.values()):
+            directory = os.path.abspath(index.directory)
+            added = [os.path.basename(f) for f in delta.added
+                     if os.path.dirname(os.path.abspath(f)) == directory]
+            removed = [os.path.basename(f) for f in delta.removed
+                       if os.path.dirname(os.path.abspath(f)) == directory]
+            if not (added or removed):
+                continue
+            self.logger.debug('Patching %s index of %s' % (index.typ, index.directory))
+            if index.apply(added, removed):
+                self._write_indexfile(index, packageindex.INDEXFILE_NAMES[index.typ])
+                changed.append(os.path.basename(directory))
+        if changed:
+            self._gen_release(sorted(set(changed)))
 
     def _make_packagesfile(self, directory):
         self._make_indexfile(directory, 'packages', 'Packages')
@@ -105,45 +190,46 @@ class ArchiveDirIndexer(DirHandler, threading.Thread):
 
     def _write_codename(filename):
         suite = self.config.release_suite
-            if not suite:
-                suite = self.name
-            f.write('Suite: ' + suite + '\n')
-            codename = self.config.release_codename
-            if not codename:
-                codename = suite
-            f.write('Codename: ' + '%s/%s\n' % (codename, arch))
+        if not suite:
+            suite = self.name
+        f.write('Suite: ' + suite + '\n')
+        codename = self.config.release_codename
+        if not codename:
+            codename = suite
+        f.write('Codename: ' + '%s/%s\n' % (codename, arch))
 
     def _hash_files_to(self, indexfiles, f):
         '''
-        write hash digest into filehandle
-        :param indexfiles: system architectures
+        write hash digest into filehandle. Each file is read only once for
+        all hashes.
+        :param indexfiles: index files relative to the archive directory
         :param f: file handle
         '''        
+        hashed = []
+        for filename in indexfiles:
+            size, digests = hasher.hash_file_multi(self._abspath(filename), self.hashes)
+            hashed.append((os.path.basename(filename), size, digests))
         for hash_ in self.hashes:
-            f.write("%s%s:\n" % (hash_.upper() + ('Sum' if hash_ == 'md5' else '')))
-            for filename in indexfiles:
-                filename = self._abspath(filename)
-                hexhash = hasher.hash_file(filename, hash_)
-                size = os.stat(filename).st_size
-                filename = os.path.basename(filename)
-                f.write(' %s% 16d %s\n' % (hexhash, size, filename))    
-
-    def _write_suite_to(f):
+            f.write("%s:\n" % (hash_.upper() + ('Sum' if hash_ == 'md5' else '')))
+            for filename, size, digests in hashed:
+                f.write(' %s% 16d %s\n' % (digests[hash_], size, filename))
+
+    def _write_suite_to(self, f):
         suite = self.config.release_suite
         if not suite:
-            suite = self.config.name
+            suite = self.name
         f.write('Suite: ' + suite + '\n')
 
-    def _write_origin_to(f):
+    def _write_origin_to(self, f):
         f.write('Origin: ' + self.config.release_origin + '\n')
     
-    def _write_label_to(f):
+    def _write_label_to(self, f):
         f.write('Label: ' + self.config.release_label + '\n')
 
-    def _write_date_to(f):
+    def _write_date_to(self, f):
         f.write('Date: ' + time.strftime("%a, %d %b %Y %H:%M:%S UTC", time.gmtime()) + '\n')
 
-    def _write_no_automatic_to(f):
+    def _write_no_automatic_to(self, f):
         if self.config.experimental_release:
             f.write('NotAutomatic: yes\n')
 
@@ -176,55 +262,52 @@ class ArchiveDirIndexer(DirHandler, threading.Thread):
     def _daemonize(self):
         self.logger.info('Entering daemon mode...')
         if self._dynamic_reindex:
-            self._dnotify = DirectoryNotifierFactory().create(self._get_dnotify_dirs(), use_dnotify=self.use_dnotify, poll_time=self._poll_time, cancel_event=die_event)
+            self._dnotify = DirectoryNotifierFactory().create(self._get_dnotify_dirs(), use_dnotify=self.use_dnotify, poll_time=self._poll_time, cancel_event=die_event, use_inotify=self.use_inotify, file_filter=packageindex.is_indexed_file)
 
-            self._async_dnotify = DirectoryNotifierAsyncWrapper(self._dnotify, self._eventqueue, self.logger=self.logger, name=self.name + " Indexer")
+            self._async_dnotify = DirectoryNotifierAsyncWrapper(self._dnotify, self._eventqueue, logger=self.logger, name=self.name + " Indexer")
             self._async_dnotify.start()
 
+        # Bursts of events (e.g. many uploads at once) are collected
+        # until things are quiet, so they cause a single reindex.
+        coalescer = EventCoalescer(self._eventqueue,
+                                   quiet_time=self.config.index_quiet_time,
+                                   max_delay=self.config.index_max_delay,
+                                   cancel_event=die_event)
+
         # The main daemon loop
         while True:
-            try:
-                # wait 1 second for a new event
-                obj = self._eventqueue.get(1)
-            except queue.Empty:
+            # wait 1 second for a new event
+            batch = coalescer.get(timeout=1)
+            if die_event.is_set():
+                break
+            if batch is None:
                 continue
-            finally:
-                if die_event.is_set():
-                    # don't worry this break is stronger
-                    # then the continue above
-                    break
 
             self.logger.debug('Reading from event queue')
-            setevent = None
-            dir = None
-            
-            if type(obj) == str:
-                self.logger.debug('got dir change')
-                dir = obj
-            elif obj is None:
-                self.logger.debug('got general event')
-                setevent = None
-            elif type(obj) == threading._Event:
-                self.logger.debug('got wait_reprocess event')
-                setevent = obj
-            else:
-                self.logger.error("unknown object %s in event queue" % obj)
-                assert None
-
-            # This is to protect against both lots of activity, and to
-            # prevent race conditions, so we can rely on timestamps.
-            time.sleep(1)
-            if self.reindex_needed:
-                if dir is None:
+            for obj in batch.others:
+                if isinstance(obj, packageindex.IndexDelta):
+                    self.logger.debug('got index delta')
+                    self._apply_delta(obj)
+                else:
+                    self.logger.error("unknown object %s in event queue" % obj)
+                    assert None
+
+            if (batch.general or batch.dirs) and self.reindex_needed:
+                if batch.general:
                     self.logger.debug('Got general change')
                     self._index_all(force=True)
                     self._gen_release_all(True)
                 else:
-                    self.logger.debug('Got change in %s' % dir)
-                    self._index([os.path.basename(os.path.abspath(dir))])
-                    self._gen_release([os.path.basename(os.path.abspath(dir))])
-            
-            if setevent:
+                    arches = []
+                    for dir in batch.dirs:
+                        arch = os.path.basename(os.path.abspath(dir))
+                        if not arch in arches:
+                            arches.append(arch)
+                    self.logger.debug('Got change in %s' % ', '.join(arches))
+                    self._index(arches)
+                    self._gen_release(arches)
+
+            for setevent in batch.events:
                 self.logger.debug('setting wait_reprocess event')
                 setevent.set()
 
@@ -234,8 +317,13 @@ class ArchiveDirIndexer(DirHandler, threading.Thread):
     def _get_uncompressed_indexfiles(self):
         raise NotImplementedError()
 
-    def _get_uncompressed_indexfiles(self):
-        for ext in compression.MultiCompressedFile.filetypes.keys():
+    def _get_all_indexfiles(self):
+        '''
+        Lists all index files written in the configured compression
+        formats (option "index_compression").
+        '''
+        for name, level in self.config.index_compression:
+            ext = compression.formats[name][0]
             for filename in self._get_uncompressed_indexfiles():
                 yield filename + ext
 
@@ -256,29 +344,39 @@ class ArchiveDirIndexer(DirHandler, threading.Thread):
     release_needed = property(_get_release_needed)
 
     def _get_reindex_needed(self):
+        # scan every directory once per pass; the indexing that follows
+        # reuses the snapshots. Only changes of the indexed files matter,
+        # not e.g. .changes files.
+        changed = False
+        for index in list(self._indices.values()):
+            changed = index.changed() or changed
         if not os.path.isfile(self._abspath('Release')):
             return True
         if self._reindex_needed_event.is_set():
             return True
-        gpg_mtime = os.stat(self._abspath('Release')).st_mtime
-        for dir in self._get_dnotify_dirs():
-            dir_mtime = os.stat(self._abspath(dir)).st_mtime
-            if dir_mtime > gpg_mtime:
-                return True
-        return False
+        if not self._indices:
+            return True
+        return changed
 
     reindex_needed = property(_get_reindex_needed)
 
     def wait_reprocess(self):
         e = threading.Event()
-        self._evenytqueue.put(e)
+        self._eventqueue.put(e)
         self.logger.debug('waiting on reprocess')
-        while not (e.isSet() or die_event.isSet()):
-            time.sleep(0.5)
+        while not (e.wait(0.5) or self.die_event.is_set()):
+            pass
         self.logger.debug('done waiting on reprocess')
 
-    def notify(self):
-        self._eventqueue.put(None)
+    def notify(self, delta=None):
+        '''
+        Tell the indexer that the archive changed.
+
+        :param delta: Optional :class:`minidinstall_ng.packageindex.IndexDelta`
+                      of the change. If given, only the affected index
+                      entries are updated.
+        '''
+        self._eventqueue.put(delta)
 
 class ArchiveDir(DirHandler):
 
@@ -288,10 +386,17 @@ class ArchiveDir(DirHandler):
         self.directory = dir
         self.name = os.path.basename(os.path.abspath(dir))
         self.logger = logger
+        self.config = config
         for key in config.keys():
             self.logger.debug("Setting \"%s\" => \"%s\" in archive \"%s\"" % ('_'+key, config[key], self.name))
             self.__dict__['_' + key] = config[key]
         do_mkdir(dir)
+        #: :class:`minidinstall_ng.blobstore.BlobStore` of the shared pool
+        self._blobstore = None
+        if config['shared_pool']:
+            self._blobstore = blobstore.get_blob_store(config['shared_pool'])
+        # finish or roll back an installation interrupted by a crash
+        transaction.recover(dir, self.logger, self._blobstore)
         self.batch_mode = batch_mode
         # if self.config.mail_on_success:
         #     self._successlogger = logging.self.logger("mini-dinstall." + self.name)
@@ -299,10 +404,13 @@ class ArchiveDir(DirHandler):
         #     mailHandler = SubjectSpecifyingLoggingSMTPHandler(mail_server, 'Mini-Dinstall <%s@%s>' % (getpass.getuser(), socket.getfqdn()), [mail_to])
         #     mailHandler.setLevel(logging.DEBUG)
         #     self._successlogger.addHandler(mailHandler)
-        self._clean_targets = []
+        self._index_delta = None
+        #: :class:`minidinstall_ng.archiveindex.ArchiveFileIndex`, built on
+        #: first use
+        self._file_index = None
 
     def _abspath(self, *args):
-        return os.path.abspath(self.directory, *args)
+        return os.path.abspath(os.path.join(self.directory, *args))
 
     def _relpath(self, *args):
         return os.path.join(self.name, *args)
@@ -310,14 +418,20 @@ class ArchiveDir(DirHandler):
     def install(self, changefilename, changefile):
         '''
         Install a changefile.
+
+        :returns: The :class:`minidinstall_ng.packageindex.IndexDelta` of
+                  the installation or :const:`None` if it failed.
         '''
         success = False
+        self._index_delta = None
         try:
             success = self._install_run_scripts(changefilename, changefile)
         except Exception:
             self.logger.exception("Unhandled exception during installation")
         if not success:
             self.logger.info('Failed to install "%s"' % changefilename)
+            return None
+        return self._index_delta
 
     def reject(self, changefilename, changefile, reason):
         self._reject_changefile(changefilename, changefile, reason)
@@ -330,18 +444,26 @@ class ArchiveDir(DirHandler):
             self.logger.info('Verifying signature on "%s"' % changefilename)
             try:
                 if self.config.keyrings:
-                    verifier = DebianSigVerifier(keyrings=self.config.keyrings)
+                    verifier = get_verifier(keyrings=self.config.keyrings)
+                else:
+                    verifier = get_verifier(extra_keyrings=self.config.extra_keyrings)
+                if changefile.signed_file is None:
+                    output = verifier.verify(changefilename)
                 else:
-                    verifier = DebianSigVerifier(extra_keyrings=self.config.extra_keyrings)
-                output = verifier.verify(changefilename)
-                self.logger.debug(output)
+                    output = verifier.verify_buffer(changefile.signed_file.raw, changefilename)
+                self.logger.debug(''.join(output))
                 self.logger.info('Good signature on "%s"' % changefilename)
             except GPGSigVerificationFailure as e:
                 msg = "Failed to verify signature on \"%s\": %s\n" % (changefilename, e)
-                msg += string.join(e.getOutput(), '')
+                msg += ''.join(e.getOutput())
                 self.logger.error(msg)
                 self._reject_changefile(changefilename, changefile, e)
                 return False
+            except GPGSigVerifierException as e:
+                # gpgv or the keyrings are missing; not the upload's fault,
+                # so leave it in incoming to be retried
+                self.logger.error('Could not verify signature on "%s": %s' % (changefilename, e))
+                return False
         else:
             self.logger.debug('Skipping signature verification on "%s"' % changefilename)
         if self.config.pre_install_script:
@@ -352,17 +474,22 @@ class ArchiveDir(DirHandler):
             except:
                 self.logger.exception("failure while running pre-installation script")
                 return False
+        target = self._changes_target(changefilename, sourcename)
         try:
-            self._install_changefile_internal(changefilename, changefile)
+            # the .changes file is installed in the same transaction
+            installed = self._install_changefile_internal(changefilename, changefile, target)
+        except transaction.TransactionException as e:
+            # an earlier installation is stuck; not the upload's fault
+            self.logger.error('Could not install "%s": %s' % (changefilename, e))
+            return False
         except Exception as e:
             self.logger.exception('Failed to process "%s"' % changefilename)
             self._reject_changefile(changefilename, changefile, e)
             return False
+        # the upload is installed; nothing from here on may reject it
+        self._record_installation(target, *installed)
         if self._chown_changes_files:
-            do_chmod(changefilename, 0600)
-        target = os.path.join(self.directory, os.path.basename(changefilename))
-        # the final step
-        do_rename(changefilename, target)
+            do_chmod(target, 0o600)
         self.logger.info('Successfully installed %s %s to %s' % (sourcename, version, self.name))
         if self._mail_on_success:
             done = False
@@ -410,133 +537,169 @@ class ArchiveDir(DirHandler):
                 return False
         return True
 
-    def _install_changefile_internal(self, changefilename, changefile):
+    def _install_changefile_internal(self, changefilename, changefile, changestarget):
+        '''
+        :returns: Tuple of the deleted old files, the installed files and
+                  the SHA256 of the uploaded files for
+                  :meth:`_record_installation`.
+        '''
         sourcename = changefile['source']
         version = changefile['version']
         incomingdir = os.path.dirname(changefilename)
         newfiles = []
-        is_native = not native_version_re.match(version)
-        if is_native:
-            (ignored, newdebianver) = parse_versions(version)
-        else:
-            (newupstreamver, newdebianver) = parse_versions(version)
+        newversion = debversion.parse_version(version)
+        is_native = newversion.is_native
         is_sourceful = 0
-        for file in map(lambda x: x[2], changefile.getFiles()):
+        for file in [entry.filename for entry in changefile.getFiles()]:
             match = debpackage_re.search(file)
             if match:
                 arch = match.group(3)
                 if not arch in self.config.arches:
                     raise DinstallException("Unknown architecture: %s" % (arch))
-                target = self._arch_target(arch, file)
+                target = self._arch_target(arch, file, sourcename)
                 newfiles.append((os.path.join(incomingdir, file), target, match.group(1), arch))
                 continue
             match = debsrc_diff_re.search(file)
             if match:
                 is_sourceful = 1
-                target = self._source_target(file)
+                target = self._source_target(file, sourcename)
                 newfiles.append((os.path.join(incomingdir, file), target, match.group(1), 'source'))
                 continue
             match = debsrc_orig_re.search(file)
             if match:
                 is_sourceful = 1
-                target = self._source_target(file)
+                target = self._source_target(file, sourcename)
                 newfiles.append((os.path.join(incomingdir, file), target, match.group(1), 'source'))
                 continue
             match = debsrc_native_re.search(file)
             if match:
                 is_sourceful = 1
-                target = self._source_target(file)
+                target = self._source_target(file, sourcename)
                 newfiles.append((os.path.join(incomingdir, file), target, match.group(1), 'source'))
                 continue
             match = debsrc_dsc_re.search(file) or debsrc_orig_re.search(file)
             if match:
                 is_sourceful = 1
-                target = self._source_target(file)
+                target = self._source_target(file, sourcename)
                 newfiles.append((os.path.join(incomingdir, file), target, match.group(1), 'source'))
                 continue
 
-        all_arches = {}
-        for arch in map(lambda x: x[3], newfiles):
-            all_arches[arch] = 1
-        completed = []
         oldfiles = []
         if not self._keep_old:
-            found_old_bins = 0
-            for (oldversion, oldarch) in map(lambda x: x[1:], self._get_package_versions()):
-                if not all_arches.has_key(oldarch) and apt_pkg.version_compare(oldversion, version) < 0:
-                    found_old_bins = 1
-            for (pkgname, arch) in map(lambda x: x[2:], newfiles):
-                if arch == 'source' and found_old_bins:
+            index = self._get_file_index(sourcename)
+            for (pkgname, arch) in set((x[2], x[3]) for x in newfiles if x[3] != 'source'):
+                oldfiles.extend(index.get_binaries(pkgname, arch))
+            for (file, (kind, oldversion)) in index.get_sources(sourcename).items():
+                if kind == 'changes':
+                    oldfiles.append(file)
+                # We skip the rest of this if it wasn't a
+                # sourceful upload; really all we do if it isn't
+                # is clean out old .changes files.
+                elif not is_sourceful:
                     continue
-                self.logger.debug('Scanning for old files')
-                for file in self._read_arch_dir(arch):
-                    match = debpackage_re.search(file)
-                    if not match:
-                        continue
-                    oldpkgname = match.group(1)
-                    oldarch = match.group(3)
-                    file = self._arch_target(arch, file)
-                    if not file in map(lambda x: x[0], oldfiles):
-                        target = file + tmp_old_suffix
-                        if oldpkgname == pkgname and oldarch == arch:
-                            oldfiles.append((file, target))
-            self.logger.debug('Scanning "%s" for old files' % (self._abspath('source')))
-            for file in self._read_source_dir():
-                file = self._source_target(file)
-                if not file in map(lambda x: x[0], oldfiles):
-                    target = file + tmp_old_suffix
-                    match = debchanges_re.search(file)
-                    if not match and is_sourceful:
-                        match = debsrc_dsc_re.search(file) or debsrc_diff_re.search(file)
-                    if match and match.group(1) == sourcename:
-                        oldfiles.append((file, target))
-                        continue
-                    # We skip the rest of this if it wasn't a
-                    # sourceful upload; really all we do if it isn't
-                    # is clean out old .changes files.
-                    if not is_sourceful:
-                        continue
-                    match = debsrc_orig_re.search(file)
-                    if match and match.group(1) == sourcename:
-                        if not is_native:
-                            (oldupstreamver, olddebianver) = parse_versions(match.group(2))
-                            if apt_pkg.version_compare(oldupstreamver, newupstreamver) < 0:
-                                self.logger.debug('old upstream tarball "%s" version %s < %s, tagging for deletion' % (file, oldupstreamver, newupstreamver))
-                                oldfiles.append((file, target))
-                                continue
-                            else:
-                                self.logger.debug('keeping upstream tarball "%s" version %s' % (file, oldupstreamver))
-                                continue
+                elif kind in ('dsc', 'diff'):
+                    oldfiles.append(file)
+                elif kind == 'orig':
+                    if not is_native:
+                        # the name of an orig tarball has only the upstream version
+                        if debversion.upstream_key(oldversion) < newversion.upstream_key:
+                            self.logger.debug('old upstream tarball "%s" version %s < %s, tagging for deletion' % (file, oldversion, newversion.upstream))
+                            oldfiles.append(file)
                         else:
-                            self.logger.debug('old native tarball "%s", tagging for deletion'  % file)
-                            oldfiles.append((file, target))
-                            continue
-                    match = debsrc_native_re.search(file)
-                    if match and match.group(1) in map(lambda x: x[2], newfiles):
-                        oldfiles.append((file, target))
-                        continue
-
-        self._clean_targets = [x[1] for x in oldfiles]
-        allrenames = oldfiles + [x[:2] for x in newfiles]
+                            self.logger.debug('keeping upstream tarball "%s" version %s' % (file, oldversion))
+                    else:
+                        self.logger.debug('old native tarball "%s", tagging for deletion'  % file)
+                        oldfiles.append(file)
+            if is_sourceful:
+                for pkgname in set(x[2] for x in newfiles):
+                    for (file, (kind, oldversion)) in index.get_sources(pkgname).items():
+                        if kind == 'native':
+                            oldfiles.append(file)
+            # a file may be found more than once, e.g. in the flat layout
+            oldfiles = sorted(set(oldfiles))
+
+        # the checksums were verified, so they name the blobs
+        hashes = dict((entry.filename, entry.sha256) for entry in changefile.getFiles())
+        txn = transaction.InstallTransaction(self.directory, self.logger, self._blobstore)
+        for oldname in oldfiles:
+            txn.remove(oldname, index.digests.get(oldname))
+        for (newname, target) in [x[:2] for x in newfiles]:
+            txn.install(newname, target, hashes.get(os.path.basename(newname)))
+        txn.install(changefilename, changestarget)
+        # rolls back by itself if the files can't be staged
+        if not txn.commit():
+            # committed, but not all files are in place yet
+            self._file_index = None
+        return oldfiles, newfiles, hashes
+
+    def _record_installation(self, changestarget, oldfiles, newfiles, hashes):
+        '''
+        Updates the file index and sets the index delta after an upload
+        was installed. If that fails the file index is just built again.
+        '''
         try:
-            while not allrenames == []:
-                (oldname, newname) = allrenames[0]
-                do_rename(oldname, newname)
-                completed.append(allrenames[0])
-                allrenames = allrenames[1:]
-        except OSError, e:
-            self.logger.exception("Failed to do rename (%s); attempting rollback" % (e.strerror,))
-            try:
-                self.logger.error(traceback.format_tb(sys.exc_traceback))
-            except:
-                pass
-            # Unwind to previous state
-            for (newname, oldname) in completed:
-                do_rename(oldname, newname)
-            raise
-            self._clean_targets = []
-        # remove old files
-        self.clean()
+            self._update_file_index(oldfiles, newfiles, changestarget, hashes)
+        except Exception:
+            self.logger.exception('Failed to update the file index of "%s"' % self.directory)
+            self._file_index = None
+        self._index_delta = packageindex.IndexDelta(added=[x[1] for x in newfiles],
+                                                    removed=oldfiles)
+
+    def _changes_target(self, changefilename, source):
+        '''
+        Where the .changes file of an installed upload of *source* goes.
+        '''
+        return os.path.join(self.directory, os.path.basename(changefilename))
+
+    def _get_file_index(self, source=None):
+        '''
+        Returns the :class:`minidinstall_ng.archiveindex.ArchiveFileIndex`
+        of the archive. It is built on first use and again whenever one of
+        the directories was changed by someone else.
+
+        :param source: The source package the index is needed for. Layouts
+                       which keep the files of each source apart only need
+                       to index these.
+        '''
+        index = self._file_index
+        if index is None or not index.is_current():
+            self.logger.debug('Scanning "%s" for package files' % self.directory)
+            index = archiveindex.ArchiveFileIndex()
+            dirs = set()
+            for arch in self.config.arches:
+                for file in self._read_arch_dir(arch):
+                    index.add_binary(self._arch_target(arch, file), arch)
+                dirs.add(os.path.dirname(self._arch_target(arch, '_')))
+            for file in self._read_source_dir():
+                index.add_source(self._source_target(file))
+            dirs.add(os.path.dirname(self._source_target('_')))
+            index.touch(dirs)
+            self._file_index = index
+        return index
+
+    def _get_package_versions(self):
+        '''
+        :returns: List of (package, version, arch) tuples of all binary
+                  packages in the archive.
+        '''
+        return self._get_file_index().package_versions()
+
+    def _update_file_index(self, oldfiles, newfiles, changestarget, hashes):
+        index = self._file_index
+        if index is None:
+            return
+        for file in oldfiles:
+            index.remove(file)
+        for (newname, target, pkgname, arch) in newfiles:
+            sha256 = hashes.get(os.path.basename(newname))
+            if arch == 'source':
+                index.add_source(target, sha256)
+            else:
+                index.add_binary(target, arch, sha256)
+        if os.path.dirname(changestarget) == os.path.dirname(self._source_target('_')):
+            index.add_source(changestarget)
+        # our own changes don't make the index stale
+        index.touch()
 
     def _reject_changefile(self, changefilename, changefile, exception):
         sourcename = changefile['source']
@@ -549,7 +712,7 @@ class ArchiveDir(DirHandler):
             else:
                 traceback.print_exception(Exception, exception, None, None, f)
             f.close()
-            for file in map(lambda x: x[2], changefile.getFiles()):
+            for file in [entry.filename for entry in changefile.getFiles()]:
                 if os.access(os.path.join(incomingdir, file), os.R_OK):
                     file = os.path.join(incomingdir, file)
                 else:
@@ -557,13 +720,7 @@ class ArchiveDir(DirHandler):
                 target = os.path.join(rejectdir, os.path.basename(file))
                 do_rename(file, target)
             do_rename(changefilename, os.path.join(rejectdir, os.path.basename(changefilename)))
-            self.logger.info('Rejecting "%s": %s' % (changefilename, `exception`))
+            self.logger.info('Rejecting "%s": %s' % (changefilename, repr(exception)))
         except Exception:
             self.logger.error("Unhandled exception while rejecting %s; archive may be in inconsistent state" % changefilename)
             raise
-
-    def clean(self):
-        self.logger.debug('Removing old files')
-        for file in self._clean_targets:
-            self.logger.debug('Deleting "%s"' % file)
-                os.unlink(file)
@@ -1,67 +1,92 @@
+#!/usr/bin/env python3
+# flat -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+The "flat" archive style, the default.
+
+All files of a distribution are stored in its directory, next to the
+``Packages``, ``Sources`` and ``Release`` files.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import os
+
+from minidinstall_ng.dist_worker import ArchiveDir, ArchiveDirIndexer
+
 class FlatArchiveDirIndexer(ArchiveDirIndexer):
     def __init__(self, *args, **kwargs):
         ArchiveDirIndexer.__init__(self, *args, **kwargs)
 
     def _index(self, arches, force=None):
         pkgsfile = self._abspath('Packages')
-        dirmtime = os.stat(self._relpath()).st_mtime
-        if force or (not os.access(pkgsfile, os.R_OK)) or dirmtime > os.stat(pkgsfile).st_mtime:
-            self._logger.info('Generating Packages file...')
+        if force or (not os.access(pkgsfile, os.R_OK)) or self._index_changed(self._relpath(), 'packages'):
+            self.logger.info('Generating Packages file...')
             self._make_packagesfile(self._relpath())
-            self._logger.info('Packages generation complete')
+            self.logger.info('Packages generation complete')
         else:
-            self._logger.info('Skipping generation of Packages file')
+            self.logger.info('Skipping generation of Packages file')
         pkgsfile = self._abspath('Sources')
-        if force or (not os.access(pkgsfile, os.R_OK)) or dirmtime > os.stat(pkgsfile).st_mtime:
-            self._logger.info('Generating Sources file...')
+        if force or (not os.access(pkgsfile, os.R_OK)) or self._index_changed(self._relpath(), 'sources'):
+            self.logger.info('Generating Sources file...')
             self._make_sourcesfile(self._relpath())
-            self._logger.info('Sources generation complete')
+            self.logger.info('Sources generation complete')
         else:
-            self._logger.info('Skipping generation of Sources file')
+            self.logger.info('Skipping generation of Sources file')
 
 
-    def _gen_release(self, arches, force):
+    def _gen_release(self, arches, force=False):
         release_file = self._abspath('Release')
-        if not self._generate_release:
+        if not self.config.generate_release:
             if os.access(release_file, os.R_OK):
-                self._logger.info("Release generation disabled, removing existing Release file")
+                self.logger.info("Release generation disabled, removing existing Release file")
                 try:
                     os.unlink(release_file)
-                except OSError, e:
+                except OSError:
                     pass
             return
-        tmpname = release_file + tmp_new_suffix
-        if self.release_needed:
-            self._logger.info("Release file is up to date.")
+        tmpname = release_file + '.new'
+        if not force and not self._get_release_needed(release_file):
+            self.logger.info("Release file is up to date.")
             return
-        self._logger.info("Generating Release...")
-        if no_act:
-            self._logger.info("Release generation complete")
+        self.logger.info("Generating Release...")
+        if self.no_act:
+            self.logger.info("Release generation complete")
             return
-        f = open(tmpname, 'w')
-        self._write_origin_to(f)
-        self._write_label_to(f)
-        self._write_suite_to(f)
-        codename = self.config.release_codename
-        if not codename:
-            codename = suite
-        f.write('Codename: ' + codename + '\n')
-        self._write_no_automatic_to(f)
-        self._write_date_to(f)
-        f.write('Architectures: ' + string.join(self._arches, ' ') + '\n')
-        if self._release_description:
-            f.write('Description: ' + self._release_description + '\n')
-        self._hash_files_to(indexfiles, f)
-        f.close()
-        if self._sign_releasefile(tmpname, self._abspath()):
+        with open(tmpname, 'w') as f:
+            self._write_origin_to(f)
+            self._write_label_to(f)
+            self._write_suite_to(f)
+            codename = self.config.release_codename
+            if not codename:
+                codename = self.config.release_suite or self.name
+            f.write('Codename: ' + codename + '\n')
+            self._write_no_automatic_to(f)
+            self._write_date_to(f)
+            f.write('Architectures: ' + ' '.join(self.config.arches) + '\n')
+            if self.config.release_description:
+                f.write('Description: ' + self.config.release_description + '\n')
+            self._hash_files_to(self._get_all_indexfiles(), f)
+        if self._sign_releasefile(os.path.basename(tmpname), self._abspath()):
             os.rename(tmpname, release_file)
-            self._logger.info("Release generation complete")
-
-    def _in_archdir(self, *args):
-        return apply(lambda x,self=self: self._abspath(x), args[1:])
+            self.logger.info("Release generation complete")
 
     def _get_dnotify_dirs(self):
-        return [self._dir]
+        return [self._abspath()]
 
     def _get_uncompressed_indexfiles(self):
         return ['Packages', 'Sources']
@@ -73,21 +98,89 @@ class FlatArchiveDir(ArchiveDir):
     indexer_class = FlatArchiveDirIndexer
 
     def _read_source_dir(self):
-        return os.listdir(self._dir)
+        return os.listdir(self._abspath())
 
     def _read_arch_dir(self, arch):
-        return os.listdir(self._dir)
+        return os.listdir(self._abspath())
 
-    def _arch_target(self, arch, file):
+    def _arch_target(self, arch, file, source=None):
         return self._abspath(file)
 
-    def _source_target(self, file):
+    def _source_target(self, file, source=None):
         return self._arch_target('source', file)
 
-    def _get_package_versions(self):
-        ret = []
-        for file in self._abspath(''):
-            match = debpackage_re.search(file)
-            if match:
-                ret.append((match.group(1), match.group(2), match.group(3)))
-        return ret
\ No newline at end of file
+
+if __name__ == '__main__':
+    import logging
+    import shutil
+    import tempfile
+    import threading
+    import unittest
+
+    from minidinstall_ng import compression
+
+    class Config(dict):
+        __getattr__ = dict.__getitem__
+
+    class TestFlat(unittest.TestCase):
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.directory = os.path.join(self.dir, 'unstable')
+            self.logger = logging.getLogger('test')
+            self.logger.disabled = True
+            self.config = Config(arches=['all', 'amd64'], shared_pool=None, use_db=False,
+                                 index_compression=list(compression.default_formats),
+                                 generate_release=True, release_origin='test',
+                                 release_label='test', release_suite=None,
+                                 release_codename=None, experimental_release=False,
+                                 release_description=None, release_signscript=None)
+            # the constructors need the daemon's globals; set up what is used
+            self.archive = self._make(FlatArchiveDir)
+            self.archive._file_index = None
+            self.indexer = FlatArchiveDirIndexer.__new__(FlatArchiveDirIndexer)
+            threading.Thread.__init__(self.indexer, name='unstable')
+            self._make(self.indexer)
+            self.indexer.no_act = False
+            self.indexer._indices = {}
+            self.indexer._release_needed_event = threading.Event()
+            self.cwd = os.getcwd()
+            # the indices use paths relative to the parent directory
+            os.chdir(self.dir)
+
+        def tearDown(self):
+            os.chdir(self.cwd)
+            shutil.rmtree(self.dir)
+
+        def _make(self, obj):
+            if isinstance(obj, type):
+                obj = obj.__new__(obj)
+            obj.directory = self.directory
+            obj.name = 'unstable'
+            obj.logger = self.logger
+            obj.config = self.config
+            return obj
+
+        def _touch(self, path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+        def test_file_index(self):
+            os.mkdir(self.directory)
+            deb = self.archive._arch_target('amd64', 'foo_1.0-1_amd64.deb')
+            dsc = self.archive._source_target('foo_1.0-1.dsc')
+            self.assertEqual(deb, os.path.join(self.directory, 'foo_1.0-1_amd64.deb'))
+            self.assertEqual(dsc, os.path.join(self.directory, 'foo_1.0-1.dsc'))
+            self._touch(deb)
+            self._touch(dsc)
+            index = self.archive._get_file_index()
+            self.assertEqual(index.get_binaries('foo', 'amd64'), {deb: '1.0-1'})
+            self.assertEqual(index.get_sources('foo'), {dsc: ('dsc', '1.0-1')})
+
+        def test_index(self):
+            os.mkdir(self.directory)
+            self.indexer._index_all(force=True)
+            self.indexer._gen_release_all(force=True)
+            for name in ['Packages', 'Packages.gz', 'Sources.xz', 'Release']:
+                self.assertTrue(os.path.exists(os.path.join(self.directory, name)), name)
+
+    unittest.main()
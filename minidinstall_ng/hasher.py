@@ -1,7 +1,43 @@
 import hashlib
+import threading
 
-standart_hashes
-BLOCKSIZE = 65536
+BLOCKSIZE = 1024 * 1024
+
+# every thread gets its own read buffer which is reused for all files
+_local = threading.local()
+
+
+def _get_buffer():
+    buf = getattr(_local, 'buffer', None)
+    if buf is None:
+        buf = _local.buffer = bytearray(BLOCKSIZE)
+    return buf
+
+
+def hash_file_multi(filename, hash_types, cancel_event=None):
+    '''
+    Computes several hashes of a file reading it only once.
+    :param filename: Path to the file
+    :param hash_types: Names of the hash algorithms.
+    :param cancel_event: Optional :class:`threading.Event`. If it gets set
+                         the hashing stops and :const:`None` is returned.
+    :returns: A tuple of the file size and a dictionary mapping each hash
+              algorithm to the hex-digest.
+    '''
+    hashers = [(hash_type, hashlib.new(hash_type)) for hash_type in hash_types]
+    buf = _get_buffer()
+    view = memoryview(buf)
+    size = 0
+    with open(filename, 'rb', buffering=0) as afile:
+        count = afile.readinto(buf)
+        while count:
+            if not cancel_event is None and cancel_event.is_set():
+                return None
+            size += count
+            for hash_type, hasher in hashers:
+                hasher.update(view[:count])
+            count = afile.readinto(buf)
+    return size, dict((hash_type, hasher.hexdigest()) for hash_type, hasher in hashers)
 
 
 def hash_file(filename, hash_type):
@@ -10,15 +46,4 @@ def hash_file(filename, hash_type):
     :param filename: Path to the file
     :param hash_type: Name of the hash algorithm.
     ''' 
-    if hash_type in hashlib.algorithms:
-        algo = getattr(hashlib, hash_type)
-    else:
-        algo = hashlib.new(hash_type)
-    hasher = algo()
-    with open(filename, 'rb') as afile:
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(BLOCKSIZE)
-    return hasher.hexdigest()
-
+    return hash_file_multi(filename, (hash_type,))[1][hash_type]
@@ -29,8 +29,13 @@ him the credits and blame me <l34k@bk.ru> for bugs.
 from minidinstall_ng.error import DinstallException
 from minidinstall_ng import sockethandler
 from minidinstall_ng import commands
-from minidinstall_ng.ChangeFile import ChangeFile
+from minidinstall_ng.ChangeFile import ChangeFile, ChangeFileException, VerifiedFileMemo
+import os
+import time
+import heapq
+import itertools
 import threading
+from collections import namedtuple
 try:
     import queue
 except ImportError:
@@ -39,34 +44,135 @@ except ImportError:
 
 ChangeFileTask = namedtuple('ChangeFileTask', ['filename', 'start_time', 'next_time', 'delay'])
 
-class KeyIndexedQueue(queue.Queue):
+class UploadProgress(object):
     '''
-    Queue extended with a :meth:`__contains__`
+    State of the readiness check of a single upload, kept between the
+    retries.
     '''
-    def __init__(self, key_index=0):
-        queue.Queue.__init__(self)
-        self._lock = threading.RLock()
-        self._keys = []
-        self._key_index = key_index
-
-    def put(self, item, block=True, timeout=None):
-        with self._lock:
-            queue.Queue.put(self, item, block, timeout)
-            self._keys.append(item[self._key_index])
+    def __init__(self):
+        #: files which already reached their final size
+        self.complete = set()
+        #: bytes received of all files at the last check
+        self.received = 0
+        #: whether the upload grew since the check before
+        self.growing = False
+
+class ScheduledTaskQueue(object):
+    '''
+    Queue of :class:`ChangeFileTask` objects which hands out each task
+    not before its :attr:`next_time`. The tasks are kept in a heap, so
+    :meth:`get` sleeps until the earliest task is due instead of cycling
+    through the pending ones.
+
+    A task's filename stays in the queue (see :meth:`__contains__`) from
+    :meth:`put` until :meth:`task_done` is called for it, so a task
+    which is processed at the moment isn't added a second time. Putting a
+    task with a filename which is already queued replaces the old one.
+
+    :param maxsize: Maximal number of queued tasks. If zero or lower the
+                    size is unlimited.
+    '''
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._cond = threading.Condition()
+        #: heap of (next_time, sequence number, task)
+        self._heap = []
+        #: filename => heap entry of the queued tasks
+        self._entries = {}
+        #: filenames of tasks handed out by get()
+        self._active = set()
+        self._counter = itertools.count()
+
+    def _full(self):
+        return self.maxsize > 0 and len(self._entries) >= self.maxsize
+
+    def put(self, task, block=True, timeout=None):
+        with self._cond:
+            if not task.filename in self._entries:
+                if not block:
+                    if self._full():
+                        raise queue.Full()
+                elif not self._cond.wait_for(lambda: not self._full(), timeout):
+                    raise queue.Full()
+            entry = (task.next_time, next(self._counter), task)
+            self._entries[task.filename] = entry
+            self._active.discard(task.filename)
+            heapq.heappush(self._heap, entry)
+            self._cond.notify_all()
+
+    def put_nowait(self, task):
+        self.put(task, block=False)
+
+    def _pop_replaced(self):
+        # drop heap entries of replaced tasks
+        while self._heap and self._entries.get(self._heap[0][2].filename) is not self._heap[0]:
+            heapq.heappop(self._heap)
 
     def get(self, block=True, timeout=None):
-        with self._lock:
-            res = queue.Queue.get(self, block, timeout)
-            index = self._keys.index(res[self._key_index])
-            if not index == 0:
-                raise RuntimeError('Queue get item is not in keys index 0')
-            del self._keys[0]
-            # TODO: replace index and del with remove after testing
+        '''
+        Returns the task which is due first. Blocks until it is due.
+
+        :raises queue.Empty: If no task gets due within *timeout* seconds
+                             or immediately if *block* is :const:`False`.
+        '''
+        end_time = None
+        if not timeout is None:
+            end_time = time.time() + timeout
+        with self._cond:
+            while True:
+                self._pop_replaced()
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    task = heapq.heappop(self._heap)[2]
+                    del self._entries[task.filename]
+                    self._active.add(task.filename)
+                    self._cond.notify_all()
+                    return task
+                if not block or (not end_time is None and now >= end_time):
+                    raise queue.Empty()
+                wait = None
+                if self._heap:
+                    wait = self._heap[0][0] - now
+                if not end_time is None:
+                    wait = end_time - now if wait is None else min(wait, end_time - now)
+                self._cond.wait(wait)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self, filename):
+        '''
+        Marks the task handed out for *filename* as finished.
+        '''
+        with self._cond:
+            self._active.discard(filename)
+
+    def qsize(self):
+        with self._cond:
+            return len(self._entries)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def __contains__(self, filename):
+        with self._cond:
+            return filename in self._entries or filename in self._active
+
 
-    def __contains__(self, value):
-        with self._lock:
-            res = self.value[self._key_index] in self._keys
-        return res
+def resolve_distribution(config, changefiledist, logger=None):
+    '''
+    Returns the name of the distribution a change file targets,
+    resolving the "alias" option of the distributions.
+
+    :param config: :class:`minidinstall_ng.config.ConfigHandler`
+    :param changefiledist: The "Distribution" field of the change file.
+    '''
+    for dist in config.distributions:
+        if config[dist]['alias'] != None and changefiledist in config[dist]['alias']:
+            if logger:
+                logger.info('Distribution "%s" is an alias for "%s"' % (changefiledist, dist))
+            return dist
+    return changefiledist
 
 
 class IncomingDirWorker(threading.Thread):
@@ -80,12 +186,17 @@ class IncomingDirWorker(threading.Thread):
                       If set to :const:`None` the Thread won't exit until
                       he got a new task.
     :param queue:     The queue to listen on.
+    :param name:      The name of the thread.
+    :param trigger_reindex: Whether or not to tell the indexer of an
+                      archive about the uploads installed into it.
     '''
     def __init__(self, archivemap, cancel_event, logger, max_retry_time,
-                 fucked_list, config, queue=None, poll_time=5):
+                 fucked_list, config, queue=None, poll_time=5,
+                 name="incom_worker", trigger_reindex=1):
         
-        threading.Thread.__init__(self, name="incom_worker")
+        threading.Thread.__init__(self, name=name)
         
+        self.fucked = fucked_list
 
         self.archivemap = archivemap
         self.cancel_event = cancel_event
@@ -93,10 +204,15 @@ class IncomingDirWorker(threading.Thread):
         self._max_retry_time = max_retry_time
         self._reprocess_queue = queue
         self._poll_time = poll_time
+        self._trigger_reindex = trigger_reindex
         self._shutdown_when_empty_event = threading.Event()
         self._stop_event = threading.Event()
-        self.changefile_queue = queue or queue.Queue()
+        self.changefile_queue = self._reprocess_queue or ScheduledTaskQueue()
         self.config = config
+        #: files of pending uploads which are already verified
+        self._verified = VerifiedFileMemo()
+        #: .changes filename => :class:`UploadProgress`
+        self._progress = {}
 
     def stop(self):
         self._stop_event.set()
@@ -107,12 +223,16 @@ class IncomingDirWorker(threading.Thread):
     def run(self):
         while not (self._stop_event.is_set() or self.cancel_event.is_set()):
             try:
+                # sleeps until the next task is due
                 task = self.changefile_queue.get(timeout=self._poll_time)             
             except queue.Empty:
-                if self._shutdown_when_empty_event.is_set():
+                if self._shutdown_when_empty_event.is_set() and self.changefile_queue.empty():
                     return
                 continue
-            self.process_task(task)
+            try:
+                self.process_task(task)
+            finally:
+                self.changefile_queue.task_done(task.filename)
 
     def process_task(self, task):
         '''
@@ -120,54 +240,100 @@ class IncomingDirWorker(threading.Thread):
                   :const:`False` otherwise.
         '''
         currtime = time.time()
-        if currtime - x.start_time > self._max_retry_time:
+        re_add = None
+        try:
+            changefile = ChangeFile.from_file(task.filename)
+        except (ChangeFileException, IOError) as e:
+            self._progress.pop(task.filename, None)
+            if not os.path.isfile(task.filename):
+                self._logger.info('Changefile "%s" got removed' % (task.filename,))
+            else:
+                self._logger.exception('Unable to load change file "%s"' % task.filename)
+                self._logger.warn('Marking "%s" as screwed' % task.filename)
+                self.fucked.append(task.filename)
+                # TODO: Handle the screwed change file?
+            return False
+
+        if currtime - task.start_time > self._max_retry_time:
             # We've tried too many times; reject it.
             err_msg = 'Couldn\'t install "%s" in %d seconds' 
             err_msg = err_msg % (task.filename, self._max_retry_time)
             exception = DinstallException(err_msg)
-            self._reject_changefile(task.filename, changefile, exception)
+            self._progress.pop(task.filename, None)
+            try:
+                self._reject_changefile(task.filename, changefile, exception)
+            except Exception:
+                self._logger.exception('Unable to reject "%s"; adding to screwed list' % (task.filename,))
+                self.fucked.append(task.filename)
             return False
 
-        re_add = None
-        if task.next_time < currtime:
+        # only the first try of an upload has no delay
+        doing_reprocess = task.delay > 0
+        if self._changefile_ready(task.filename, changefile):
+            # Let's do it!
+            self._progress.pop(task.filename, None)
+            self._logger.debug('Preparing to install "%s"' % (task.filename,))
             try:
-                changefile = ChangeFile.from_file(task.filename)
-            except (ChangeFileException, IOError) as e:
-                if not os.path.isfile(task.filename):
-                    self._logger.info('Changefile "%s" got removed' % (task.filename,))
-                else:
-                    self._logger.exception('Unable to load change file "%s"' % task.filename)
-                    self._logger.warn('Marking "%s" as screwed' % task.filename)
-                    self.fucked.append(task.filename)
-                    # TODO: Handle the screwed change file?
-                return False
-
-            if self._changefile_ready(task.filename, changefile):
-                # Let's do it!
-                self._logger.debug('Preparing to install "%s"' % (task.filename,))
-                try:
-                    self._install_changefile(task.filename, changefile, doing_reprocess)
-                except:
-                    self._logger.exception("Unable to install \"%s\"; adding to screwed list" % (task.filename,))
-                    self.fucked.append(task.filename)
-                return False
-            else:
-                delay = task.delay * 2
-                if delay > 60 * 60:
-                    delay = 60 * 60
-                self._logger.info('Upload "%s" isn\'t complete; marking for retry in %d seconds' % (task.filename, delay))
-                # set next time and delay
-                re_add = ChangeFileTask(task.filename, task.start_time, curtime + delay, delay)
+                self._install_changefile(task.filename, changefile, doing_reprocess)
+            except:
+                self._logger.exception("Unable to install \"%s\"; adding to screwed list" % (task.filename,))
+                self.fucked.append(task.filename)
+            return False
         else:
-            re_add = task
+            progress = self._progress.get(task.filename)
+            if not progress is None and progress.growing:
+                # still uploading; don't back off
+                delay = max(task.delay, 1)
+            else:
+                delay = max(task.delay * 2, 1)
+            if delay > 60 * 60:
+                delay = 60 * 60
+            self._logger.info('Upload "%s" isn\'t complete; marking for retry in %d seconds' % (task.filename, delay))
+            # set next time and delay
+            re_add = ChangeFileTask(task.filename, task.start_time, currtime + delay, delay)
 
         if re_add:
             try:
-                self._reprocess_queue.put(re_add, timeout=2)
+                self.changefile_queue.put(re_add, timeout=2)
                 return True
             except queue.Full:
                 self._logger.error("Queue got full while processing packages. Don't know what to do with reprocess task!")
                 return False
+
+    def _changefile_ready(self, filename, changefile):
+        try:
+            dist = changefile['distribution']
+        except KeyError as e:
+            self._logger.warn("Unable to read distribution field for \"%s\"; data: %s" % (filename, changefile,))
+            return False
+        sourcedir = os.path.dirname(filename)
+        progress = self._progress.get(filename)
+        if progress is None:
+            progress = self._progress[filename] = UploadProgress()
+        # only stat the files until all of them have their final size
+        try:
+            complete, incomplete = changefile.check_sizes(sourcedir, skip=progress.complete)
+        except ChangeFileException:
+            return False
+        progress.complete.update(complete)
+        # count the completed files too, else finishing one looks like a stall
+        received = sum(size for size, expected_size in incomplete.values())
+        received += sum(entry.size for entry in changefile.getFiles()
+                        if entry.filename in progress.complete)
+        progress.growing = received > progress.received
+        progress.received = received
+        if incomplete:
+            self._logger.debug('Upload "%s": %d of %d files complete' % (filename, len(progress.complete), len(progress.complete) + len(incomplete)))
+            return False
+        try:
+            changefile.verify(sourcedir,
+                              max_workers=self.config.all.verify_threads,
+                              memo=self._verified)
+        except ChangeFileException:
+            # maybe a file got replaced; stat everything again next time
+            progress.complete.clear()
+            return False
+        return True
            
 
     def _install_changefile(self, filename, changefile,
@@ -179,29 +345,19 @@ class IncomingDirWorker(threading.Thread):
         :param changefile: :class:minidinstall_ng.ChangeFile` object.
 
         '''
-        changefiledist = changefile['distribution']
-        alias_dist = None
-        for dist in self.config.distributions():
-            if self.config[dist]['alias'] != None and changefiledist in distributions[dist]['alias']:
-                self._logger.info('Distribution "%s" is an alias for "%s"' % (changefiledist, dist))
-                alias_dist = dist
-                break
-        if alias_dist:
-            dist = alias_dist
-        else:
-            dist = changefiledist
+        dist = resolve_distribution(self.config, changefile['distribution'], self._logger)
         if not dist in self.config.distributions:
             raise DinstallException('Unknown distribution "%s" in \"%s\"' % (dist, filename,))
         dist_thread_name = self.archivemap[dist][1].getName()
         self._logger.debug('Installing %s in archive %s' % (filename, dist_thread_name))
-        self.archivemap[dist][0].install(filename, changefile)
+        delta = self.archivemap[dist][0].install(filename, changefile)
         if self._trigger_reindex:
             if doing_reprocess:
                 self._logger.debug('Waiting on archive %s to reprocess' % dist_thread_name)
                 self.archivemap[dist][1].wait_reprocess()
             else:
                 self._logger.debug('Notifying archive %s of change' % dist_thread_name)
-                self.archivemap[dist][1].notify()
+                self.archivemap[dist][1].notify(delta)
             self._logger.debug('Finished processing %s' % filename)
 
     def _reject_changefile(self, filename, changefile, e):
@@ -211,6 +367,70 @@ class IncomingDirWorker(threading.Thread):
         self.archivemap[dist][0].reject(filename, changefile, e)
 
 
+class IncomingDirWorkerPool(object):
+    '''
+    Runs one :class:`IncomingDirWorker` (a lane) per distribution of the
+    *archivemap*, each with its own :class:`ScheduledTaskQueue`. Uploads
+    to different archives are installed in parallel, while uploads to
+    the same archive keep their order. Uploads for unknown distributions
+    go to an extra lane. There, like before, installing them fails and
+    they are added to the screwed list and left in incoming, without
+    holding up the other lanes.
+
+    The parameters are passed to the workers.
+    '''
+    def __init__(self, archivemap, cancel_event, logger, max_retry_time,
+                 fucked_list, config, poll_time=5, trigger_reindex=1):
+        self._config = config
+        self._logger = logger
+        #: distribution (:const:`None` for unknown ones) => worker
+        self._lanes = {}
+        for dist in list(archivemap) + [None]:
+            name = "incom_worker"
+            if not dist is None:
+                name += " " + dist
+            self._lanes[dist] = IncomingDirWorker(archivemap, cancel_event, logger,
+                                                  max_retry_time, fucked_list, config,
+                                                  queue=ScheduledTaskQueue(),
+                                                  poll_time=poll_time, name=name,
+                                                  trigger_reindex=trigger_reindex)
+
+    def _lane(self, changefile):
+        try:
+            dist = resolve_distribution(self._config, changefile['distribution'])
+        except KeyError:
+            dist = None
+        return self._lanes.get(dist, self._lanes[None])
+
+    def put(self, task, changefile, block=True, timeout=None):
+        '''
+        Queues *task* in the lane of the distribution *changefile* targets.
+        '''
+        self._lane(changefile).changefile_queue.put(task, block, timeout)
+
+    def put_nowait(self, task, changefile):
+        self.put(task, changefile, block=False)
+
+    def __contains__(self, filename):
+        return any(filename in lane.changefile_queue for lane in self._lanes.values())
+
+    def start(self):
+        for lane in self._lanes.values():
+            lane.start()
+
+    def stop(self):
+        for lane in self._lanes.values():
+            lane.stop()
+
+    def shutdown_when_finished(self):
+        for lane in self._lanes.values():
+            lane.shutdown_when_finished()
+
+    def join(self, timeout=None):
+        for lane in self._lanes.values():
+            lane.join(timeout)
+
+
 class IncomingDir(threading.Thread):
     '''
     Worker which keeps control over a single incoming folder.
@@ -220,6 +440,8 @@ class IncomingDir(threading.Thread):
                       error occurs.
     :param logger: The logger to use.
     :param trigger_reindex: Whether or not to trigger a reindex.
+    :param use_dnotify: Use the dnotify program to watch the directory.
+    :param use_inotify: Use inotify to watch the directory if available.
     :param config: The main configuration. (Object of type 
                    :class:`minidinstall_ng.config.ConfigHandler`)
     '''
@@ -227,12 +449,17 @@ class IncomingDir(threading.Thread):
                  trigger_reindex=1,
                  poll_time=30,
                  max_retry_time=172800,
-                 batch_mode=0):
+                 batch_mode=0,
+                 use_dnotify=0,
+                 use_inotify=1):
         threading.Thread.__init__(self, name="incoming")
         
         #: fucked packages. yup. fucked. 
         self.fucked = []
-        self._worker = IncomingDirWorker(archivemap, cancel_event, max_retry_time)
+        #: one installer lane per distribution
+        self._worker = IncomingDirWorkerPool(archivemap, cancel_event, logger,
+                                             max_retry_time, self.fucked, config,
+                                             trigger_reindex=trigger_reindex)
 
         self.cancel_event = cancel_event
         self._dir = dir
@@ -240,10 +467,14 @@ class IncomingDir(threading.Thread):
         self._trigger_reindex = trigger_reindex
         self._poll_time = poll_time
         self._batch_mode = batch_mode
+        self._use_dnotify = use_dnotify
+        self._use_inotify = use_inotify
         self._last_failed_targets = {}
+        #: filename => ((mtime_ns, size), changefile or None if unparsable)
+        self._changefile_cache = {}
         self._eventqueue = queue.Queue()
-        # ensure we always have some reprocess queue
-        self._reprocess_queue = CheckedIndexedQueue()
+        # the workers keep the reprocess queues
+        self._reprocess_queue = self._worker
         self._done_event = threading.Event()
         self._task_queue = queue.Queue()
         self._rescan_event = threading.Event()
@@ -285,33 +516,46 @@ class IncomingDir(threading.Thread):
         '''
         Generator function which lists all changes file in the directory
         :attr:`_dir` which are not in the :attr:`_reprocess_queue`.
+
+        The results of parsing are cached by mtime and size, so only new
+        or modified changes files are parsed again.
         '''
-        for filename in os.listdir(self._dir):
-            if not filename.endswith('.changes'):
+        seen = set()
+        with os.scandir(self._dir) as entries:
+            entries = [entry for entry in entries if entry.name.endswith('.changes')]
+        for entry in entries:
+            filename = os.path.join(self._dir, entry.name)
+            seen.add(filename)
+            if filename in self._reprocess_queue:
+                self._logger.debug('Skipping "%s" during new scan because it\'s already in the reprocess queue.' % (filename,))
                 continue
-            filename = os.path.join(self._dir, filename)
-            if not filename in self._reprocess_queue:
+            if filename in self.fucked:
+                self._logger.debug("Skipping screwed changefile \"%s\"" % (filename,))
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            key = (st.st_mtime_ns, st.st_size)
+            cached = self._changefile_cache.get(filename)
+            if not cached is None and cached[0] == key:
+                changefile = cached[1]
+                if changefile is None:
+                    continue
+            else:
                 self._logger.info('Examining "%s"' % (filename,))
                 try:
-                    ChangeFile.from_file(filename)
+                    changefile = ChangeFile.from_file(filename)
                 except ChangeFileException:
                     self._logger.debug("Unable to parse \"%s\", skipping" % (filename,))
+                    changefile = None
+                self._changefile_cache[filename] = (key, changefile)
+                if changefile is None:
                     continue
-                yield (filename, changefile)
-            else:
-                self._logger.debug('Skipping "%s" during new scan because it\'s already in the reprocess queue.' % (filename,))
-
-    def _changefile_ready(self, filename, changefile):
-        try:
-            dist = changefile['distribution']
-        except KeyError as e:
-            self._logger.warn("Unable to read distribution field for \"%s\"; data: %s" % (filename, changefile,))
-            return False
-        try:
-            changefile.verify(self._abspath(''))
-        except ChangeFileException:
-            return False
-        return True
+            yield (filename, changefile)
+        # forget files which are gone
+        for filename in set(self._changefile_cache) - seen:
+            del self._changefile_cache[filename]
 
 
     def _get_socket_server(self, socket_name):
@@ -356,9 +600,6 @@ class IncomingDir(threading.Thread):
         '''
         self._rescan_event.clear()
         for (filename, changefile) in self._get_changefiles():
-            if filename in self.fucked:
-                self._logger.info("Skipping screwed changefile \"%s\"" % (filename,))
-                continue
             # Have we tried this changefile before?
             if filename in self._reprocess_queue:
                 continue
@@ -368,7 +609,7 @@ class IncomingDir(threading.Thread):
             curtime = time.time()
             task = ChangeFileTask(filename, curtime, curtime, 0)
             try:
-                self._reprocess_queue.put_nowait(task)
+                self._reprocess_queue.put_nowait(task, changefile)
             except queue.Full:
                 self._logger.warning("Queue is full. Leave changefile for the next scan.")
                 self._rescan_event.set()
@@ -386,7 +627,7 @@ class IncomingDir(threading.Thread):
 
         if not batch_mode:
             self._logger.info('Starting notify threads...')
-            self._dnotify = DirectoryNotifierFactory().create([self._dir], use_dnotify=use_dnotify, poll_time=self._poll_time, cancel_event=self.cancel_event)
+            self._dnotify = DirectoryNotifierFactory().create([self._dir], use_dnotify=self._use_dnotify, poll_time=self._poll_time, cancel_event=self.cancel_event, use_inotify=self._use_inotify)
             self._async_dnotify = DirectoryNotifierAsyncWrapper(self._dnotify, self._eventqueue, logger=self._logger, name="Incoming watcher")
             self._async_dnotify.start()
             self._start_server()
@@ -427,4 +668,95 @@ class IncomingDir(threading.Thread):
             else:
                 time.sleep(0.5)
             if batch_mode:
-                break
\ No newline at end of file
+                break
+
+if __name__ == '__main__':
+    import hashlib
+    import logging
+    import shutil
+    import tempfile
+    import unittest
+
+    class Config(dict):
+        __getattr__ = dict.__getitem__
+
+    class FakeArchive(object):
+        def __init__(self):
+            self.calls = []
+
+        def install(self, filename, changefile):
+            self.calls.append(('install', filename))
+            return 'delta'
+
+        def reject(self, filename, changefile, e):
+            self.calls.append(('reject', filename))
+
+        def notify(self, delta=None):
+            self.calls.append(('notify', delta))
+
+        def wait_reprocess(self):
+            self.calls.append(('wait_reprocess',))
+
+        def getName(self):
+            return 'unstable'
+
+    class TestIncomingDirWorker(unittest.TestCase):
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.archive = FakeArchive()
+            config = Config(distributions=['unstable'],
+                            all=Config(verify_threads=1),
+                            unstable={'alias': None})
+            logger = logging.getLogger('test')
+            logger.disabled = True
+            self.worker = IncomingDirWorker({'unstable': (self.archive, self.archive)},
+                                            threading.Event(), logger, 60, [], config)
+            data = b'data'
+            self.changes = os.path.join(self.dir, 'foo_1_all.changes')
+            with open(self.changes, 'w') as f:
+                f.write('Source: foo\nVersion: 1\nDistribution: unstable\n'
+                        'Files:\n %s %d misc optional foo_1_all.deb\n'
+                        'Checksums-Sha1:\n %s %d foo_1_all.deb\n'
+                        'Checksums-Sha256:\n %s %d foo_1_all.deb\n'
+                        % (hashlib.md5(data).hexdigest(), len(data),
+                           hashlib.sha1(data).hexdigest(), len(data),
+                           hashlib.sha256(data).hexdigest(), len(data)))
+            self.deb = os.path.join(self.dir, 'foo_1_all.deb')
+            self.data = data
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _retry(self):
+            self.assertTrue(self.worker.process_task(ChangeFileTask(self.changes, time.time(),
+                                                                    time.time(), 0)))
+            # due after its delay of one second
+            task = self.worker.changefile_queue.get(timeout=2)
+            self.assertEqual(task.delay, 1)
+            return task
+
+        def test_retry_limit(self):
+            # the .deb never arrives
+            task = self._retry()
+            self.assertEqual(self.archive.calls, [])
+            task = task._replace(start_time=time.time() - 61)
+            self.assertFalse(self.worker.process_task(task))
+            self.assertEqual(self.archive.calls, [('reject', self.changes)])
+            self.assertTrue(self.worker.changefile_queue.empty())
+
+        def test_reprocess(self):
+            task = self._retry()
+            with open(self.deb, 'wb') as f:
+                f.write(self.data)
+            self.assertFalse(self.worker.process_task(task))
+            self.assertEqual(self.archive.calls, [('install', self.changes), ('wait_reprocess',)])
+            self.assertEqual(self.worker.fucked, [])
+
+        def test_first_try(self):
+            with open(self.deb, 'wb') as f:
+                f.write(self.data)
+            task = ChangeFileTask(self.changes, time.time(), time.time(), 0)
+            self.assertFalse(self.worker.process_task(task))
+            self.assertEqual(self.archive.calls, [('install', self.changes), ('notify', 'delta')])
+
+    unittest.main()
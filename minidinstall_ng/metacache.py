@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# metacache -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+Persistent cache for the control data and checksums of indexed files.
+
+Entries are keyed by the path of the file and are only valid as long as
+size, mtime and inode of the file stay the same, so the cache survives
+restarts of the daemon without ever returning stale data.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    control TEXT NOT NULL,
+    checksums TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_inode ON files (inode);
+'''
+
+
+class MetadataCache(object):
+    '''
+    :param filename: The database file. It is created if it doesn't exist.
+
+    The *key* arguments are the tuples returned by
+    :func:`minidinstall_ng.packageindex.stat_key`.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        # the indexer creates the cache but uses it in its own thread
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def get(self, path, key):
+        '''
+        :returns: A tuple of the control fields (a list of name, value
+                  pairs) and the checksum dictionary stored for *path* or
+                  :const:`None` if there is no valid entry.
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, inode, control, checksums '
+                                   'FROM files WHERE path = ?', (path,)).fetchone()
+        if not row is None and tuple(row[:3]) != tuple(key):
+            # the file changed since it was cached
+            self.discard(path)
+            row = None
+        if row is None:
+            # maybe another name of the same file, e.g. a hardlink in
+            # another distribution
+            size, mtime_ns, inode = key
+            with self._lock:
+                row = self._db.execute('SELECT size, mtime_ns, inode, control, checksums '
+                                       'FROM files WHERE inode = ? AND size = ? AND mtime_ns = ? '
+                                       'LIMIT 1', (inode, size, mtime_ns)).fetchone()
+            if row is None:
+                return None
+            control, checksums = json.loads(row[3]), json.loads(row[4])
+            self.put(path, key, control, checksums)
+            return [tuple(field) for field in control], checksums
+        return [tuple(field) for field in json.loads(row[3])], json.loads(row[4])
+
+    def put(self, path, key, control, checksums):
+        '''
+        Stores the data of *path*, replacing any older entry.
+
+        :param control: List of (field name, value) pairs.
+        :param checksums: Dictionary mapping hash names to hex digests.
+        '''
+        size, mtime_ns, inode = key
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                             (path, size, mtime_ns, inode,
+                              json.dumps(control), json.dumps(checksums)))
+
+    def discard(self, path):
+        with self._lock:
+            self._db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+def get_shared_cache(filename):
+    '''
+    :returns: The :class:`MetadataCache` of *filename*, shared by all
+              callers, e.g. the indexers of the distributions using one
+              shared pool.
+    '''
+    filename = os.path.abspath(filename)
+    with _shared_lock:
+        cache = _shared.get(filename)
+        if cache is None:
+            cache = _shared[filename] = MetadataCache(filename)
+        return cache
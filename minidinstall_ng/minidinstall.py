@@ -28,6 +28,7 @@ Description goes here
 import argparse
 from minidinstall_ng.config import ConfigHandler
 from minidinstall_ng import config_types as types
+from minidinstall_ng import compression
 from minidinstall_ng.version import pkg_version
 from minidinstall_ng.osactions import OsActions
 import minidinstall_ng.pidlock as lock
@@ -65,6 +66,7 @@ class MiniDinstall(object):
         'socket_permissions':(types.IntWithBase(8), int('750', 8)),
         'logfile_name':(str, 'mini-dinstall.log'),
         'use_dnotify':(types.str_bool, False),
+        'use_inotify':(types.str_bool, True),
         'trigger_reindex':(int, 1),
         'configfiles':(types.StrList(type=types.path), ['/etc/mini-dinstall.conf', '~/.mini-dinstall.conf']),
         'arches':(types.str_list, ('all', 'i386', 'amd64')),
@@ -72,7 +74,10 @@ class MiniDinstall(object):
         # 
         'alias': (str, None),
         'poll_time':(int, 30),
+        'index_quiet_time':(float, 1),
+        'index_max_delay':(float, 10),
         'max_retry_time':(int, 2 * 24 * 60 * 60),
+        'verify_threads':(int, 4),
         'mail_on_success':(types.str_bool, True),
         'mail_log_level':(types.loglevel, logging.ERROR),
         'mail_log_flush_level':(types.loglevel, logging.ERROR),
@@ -90,7 +95,9 @@ class MiniDinstall(object):
         'tweet_user':(str, None),
         'tweet_password':(str, None),
         'tweet_template':(str, "Installed %(source)s %(version)s to %(distribution)s"),
-        'archive_style':(str, 'flat'),
+        'archive_style':(types.Choices(('flat', 'simple-subdir', 'pool')), 'flat'),
+        'shared_pool':(types.path, None),
+        'use_db':(types.str_bool, True),
         'extra_keyrings':(types.str_list, ()),
         'keyrings':(types.str_list, None),
         'verify_sigs':(types.str_bool, os.access('/usr/share/keyrings/debian-keyring.gpg', os.R_OK)),
@@ -99,6 +106,7 @@ class MiniDinstall(object):
         'dynamic_reindex': (types.str_bool, True),
         'chown_changes_files': (types.str_bool, True),
         'keep_old': (types.str_bool, False),
+        'index_compression': (types.compression_list, list(compression.default_formats)),
         'generate_release': (types.str_bool, False),
         'release_origin': (str, getpass.getuser()),
         'release_label': (str, getpass.getuser()),
@@ -180,6 +188,10 @@ class MiniDinstall(object):
         self.c = self.config.all
         self.logger = self._get_logger(arguments)
         self.os = OsActions(arguments.no_act, self.logger)
+        if arguments.no_db:
+            # overrides the config files, also of the distributions
+            for section in ['all'] + self.config.distributions:
+                self.config[section]['use_db'] = 'no'
         errno = self._config_paths(arguments)
         if errno:
             return errno
@@ -267,7 +279,7 @@ parser.add_argument('-n', '--no-act', action='store_true', help='Don\'t actually
 parser.add_argument('-b', '--batch', action='store_true', help='Don\'t daemonize; run once, then exit')
 parser.add_argument('-r', '--run', action='store_true', help='Process queue immediately')
 parser.add_argument('-k', '--kill', action='store_true', help='Kill the running mini-dinstall')
-parser.add_argument('--no-db', action='store_true', help='Disable lookups on package database')
+parser.add_argument('--no-db', action='store_true', help='Don\'t cache package data in a database (sets "use_db" to "no")')
 parser.add_argument('--version', action='version', version='%(prog)s ' + pkg_version, help='Print the software version and exit')
 parser.add_argument('DIRECTORY', nargs='?', default=None)
 
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+# packageindex -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+In-process generator for the "Packages" and "Sources" index files.
+
+This replaces the call of ``apt-ftparchive``. The control member of each
+``.deb`` and each ``.dsc`` is read only once, the resulting paragraphs are
+kept in memory and written out again on each reindex.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import io
+import os
+import tarfile
+from collections import namedtuple
+from minidinstall_ng import hasher, dirsnapshot
+from minidinstall_ng.error import DinstallException
+from minidinstall_ng.DpkgControl import DpkgParagraph, iter_lazy_paragraphs
+from minidinstall_ng.SignedFile import SignedFile
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+
+#: Hashes written into the index files.
+HASHES = ('md5', 'sha1', 'sha256')
+
+#: Names of the checksum fields in a "Packages" file.
+PACKAGES_HASH_FIELDS = {'md5': 'MD5sum', 'sha1': 'SHA1', 'sha256': 'SHA256'}
+
+#: Names of the checksum fields in a "Sources" file.
+SOURCES_HASH_FIELDS = {'md5': 'Files', 'sha1': 'Checksums-Sha1',
+                       'sha256': 'Checksums-Sha256'}
+
+#: An indexed file. *key* is used to detect changes of the file,
+#: *stanza* is the paragraph as written into the index file.
+IndexEntry = namedtuple('IndexEntry', ['key', 'stanza'])
+
+#: Files added to and removed from an archive by a single installation.
+#: Both are lists of absolute paths.
+IndexDelta = namedtuple('IndexDelta', ['added', 'removed'])
+
+#: Names of the index files by index type.
+INDEXFILE_NAMES = {'packages': 'Packages', 'sources': 'Sources'}
+
+
+class IndexException(DinstallException):
+    pass
+
+
+def stat_key(st):
+    '''
+    Returns a key which changes whenever the file described by the
+    :func:`os.stat` result *st* gets replaced or modified.
+    '''
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def _read_ar_member(f, prefix):
+    '''
+    Returns name and content of the first member of the ar archive *f*
+    whose name starts with *prefix*.
+    '''
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise IndexException('Not an ar archive')
+    while True:
+        header = f.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            raise IndexException('No member %r found' % prefix)
+        name = header[:16].decode('ascii').strip().rstrip('/')
+        size = int(header[48:58])
+        if name.startswith(prefix):
+            return name, f.read(size)
+        # members are aligned to even offsets
+        f.seek(size + size % 2, os.SEEK_CUR)
+
+
+def _set_field(paragraph, key, value):
+    newkey = key.lower()
+    paragraph.trueFieldCasing[newkey] = key
+    paragraph[newkey] = value
+
+
+def paragraph_from_fields(fields):
+    '''
+    Builds a paragraph from a list of (field name, value) pairs as
+    returned by :func:`paragraph_fields`.
+    '''
+    paragraph = DpkgParagraph()
+    for key, value in fields:
+        _set_field(paragraph, key, value)
+    return paragraph
+
+
+def paragraph_fields(paragraph):
+    '''
+    Returns the fields of *paragraph* with their original casing.
+    '''
+    return [(paragraph.trueFieldCasing.get(key, key), value)
+            for key, value in paragraph.items()]
+
+
+def deb_control(filename):
+    '''
+    Reads the control file of a binary package.
+
+    :param filename: Path to the ``.deb``.
+    :returns: :class:`minidinstall_ng.DpkgControl.DpkgParagraph`
+    '''
+    with open(filename, 'rb') as f:
+        name, data = _read_ar_member(f, 'control.tar')
+    if name.endswith('.zst'):
+        if zstandard is None:
+            raise IndexException('Can\'t read %s of "%s" without the zstandard module' % (name, filename))
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:*') as tar:
+        for member in tar:
+            if member.name in ('./control', 'control'):
+                content = tar.extractfile(member).read()
+                break
+        else:
+            raise IndexException('No control file in %s of "%s"' % (name, filename))
+    paragraph = DpkgParagraph()
+    paragraph.load_buffer(content)
+    return paragraph
+
+
+def dsc_control(filename):
+    '''
+    Reads the (possibly signed) control data of a source package.
+
+    :param filename: Path to the ``.dsc``.
+    :returns: :class:`minidinstall_ng.DpkgControl.DpkgParagraph`
+    '''
+    paragraph = DpkgParagraph()
+    f = SignedFile.from_file(filename)
+    paragraph.load_buffer(f.buffer, start=f.body_start, end=f.body_end)
+    return paragraph
+
+
+def packages_paragraph(control, filename, size, checksums):
+    '''
+    Builds the "Packages" paragraph of a binary package.
+
+    :param control: The control paragraph of the package.
+    :param filename: Value of the "Filename" field.
+    :param size: Size of the package in bytes.
+    :param checksums: Dictionary mapping :data:`HASHES` to hex digests.
+    '''
+    def add_file_fields():
+        _set_field(paragraph, 'Filename', filename)
+        _set_field(paragraph, 'Size', str(size))
+        for hash_ in HASHES:
+            _set_field(paragraph, PACKAGES_HASH_FIELDS[hash_], checksums[hash_])
+
+    paragraph = DpkgParagraph()
+    for key, value in control.items():
+        if key == 'description':
+            # apt-ftparchive puts the file fields before the description
+            add_file_fields()
+        _set_field(paragraph, control.trueFieldCasing.get(key, key), value)
+    if not 'filename' in paragraph:
+        add_file_fields()
+    return paragraph
+
+
+def sources_paragraph(control, directory, filename, size, checksums):
+    '''
+    Builds the "Sources" paragraph of a source package.
+
+    :param control: The control paragraph of the ``.dsc``.
+    :param directory: Value of the "Directory" field.
+    :param filename: Basename of the ``.dsc``.
+    :param size: Size of the ``.dsc`` in bytes.
+    :param checksums: Dictionary mapping :data:`HASHES` to hex digests of
+                      the ``.dsc``.
+    '''
+    paragraph = DpkgParagraph()
+    for key, value in control.items():
+        if key == 'source':
+            _set_field(paragraph, 'Package', value)
+            continue
+        _set_field(paragraph, control.trueFieldCasing.get(key, key), value)
+    # the file lists don't contain the .dsc itself
+    for hash_ in HASHES:
+        field = SOURCES_HASH_FIELDS[hash_]
+        if hash_ != 'md5' and not field.lower() in paragraph:
+            continue
+        value = paragraph.get(field.lower(), [''])
+        if not isinstance(value, list):
+            value = [value]
+        line = '%s %d %s' % (checksums[hash_], size, filename)
+        _set_field(paragraph, field, [value[0], line] + value[1:])
+    _set_field(paragraph, 'Directory', directory)
+    return paragraph
+
+
+class PackageIndex(object):
+    '''
+    The "Packages" or "Sources" index of a single directory.
+
+    :param directory: The directory containing the packages. It is written
+                      into the "Filename" or "Directory" fields as given,
+                      so it should be relative to the archive root.
+    :param typ: Either ``'packages'`` or ``'sources'``.
+    :param logger: The logger to use.
+    :param cache: Optional :class:`minidinstall_ng.metacache.MetadataCache`
+                  used to keep control data and checksums across restarts.
+    '''
+    suffixes = {
+        'packages': ('.deb', '.udeb'),
+        'sources': ('.dsc',)
+    }
+
+    def __init__(self, directory, typ, logger, cache=None):
+        if not typ in self.suffixes:
+            raise ValueError('Unknown index type %r' % typ)
+        self.directory = directory
+        self.typ = typ
+        self._logger = logger
+        self._cache = cache
+        #: basename => :class:`IndexEntry`
+        self._entries = {}
+        #: :class:`minidinstall_ng.dirsnapshot.DirectorySnapshot` of the
+        #: last update
+        self._snapshot = None
+        #: snapshot taken by :meth:`changed`, reused by the next
+        #: :meth:`update`
+        self._scan = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _read_file(self, path, key):
+        '''
+        Returns the control paragraph and the checksums of *path*, from the
+        cache if possible.
+        '''
+        if not self._cache is None:
+            cached = self._cache.get(path, key)
+            if not cached is None:
+                fields, checksums = cached
+                return paragraph_from_fields(fields), checksums
+        self._logger.debug('Reading "%s"' % path)
+        size, checksums = hasher.hash_file_multi(path, HASHES)
+        if self.typ == 'packages':
+            control = deb_control(path)
+        else:
+            control = dsc_control(path)
+        if not self._cache is None:
+            self._cache.put(path, key, paragraph_fields(control), checksums)
+        return control, checksums
+
+    def _make_stanza(self, path, st, key):
+        control, checksums = self._read_file(path, key)
+        if self.typ == 'packages':
+            paragraph = packages_paragraph(control, path, st.st_size, checksums)
+        else:
+            paragraph = sources_paragraph(control, self.directory,
+                                          os.path.basename(path), st.st_size, checksums)
+        out = io.StringIO()
+        paragraph._store(out)
+        return out.getvalue()
+
+    def _add_file(self, name):
+        '''
+        Reads *name* into the index unless it is unchanged.
+
+        :returns: A tuple of two booleans: whether the file is in the index
+                  and whether the index changed.
+        '''
+        path = os.path.join(self.directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            # removed in the meantime
+            return False, self._drop_file(name)
+        key = stat_key(st)
+        entry = self._entries.get(name)
+        if not entry is None and entry.key == key:
+            return True, False
+        try:
+            stanza = self._make_stanza(path, st, key)
+        except (IndexException, EnvironmentError, tarfile.TarError, UnicodeDecodeError) as e:
+            self._logger.warning('Skipping "%s": %s' % (path, e))
+            return False, self._drop_file(name)
+        self._entries[name] = IndexEntry(key, stanza)
+        return True, True
+
+    def _drop_file(self, name):
+        if not name in self._entries:
+            return False
+        self._logger.debug('Dropping "%s" from index' % os.path.join(self.directory, name))
+        del self._entries[name]
+        if not self._cache is None:
+            self._cache.discard(os.path.join(self.directory, name))
+        return True
+
+    def _wanted(self, name):
+        return name.endswith(self.suffixes[self.typ])
+
+    def changed(self, rescan=True):
+        '''
+        Whether files were added to, removed from or modified in the
+        directory since the last update. The directory is scanned once;
+        the following :meth:`update` works with the same snapshot.
+
+        :param rescan: If :const:`False` the snapshot of the last call is
+                       used again if there is one.
+        '''
+        if rescan or self._scan is None:
+            self._scan = dirsnapshot.DirectorySnapshot(self.directory, filter=self._wanted)
+        if self._snapshot is None:
+            return True
+        return bool(self._snapshot.diff(self._scan))
+
+    def update(self):
+        '''
+        Rescans the directory. Only files which are new or changed since the
+        last call are read.
+
+        :returns: :const:`True` if the index changed.
+        '''
+        changed = False
+        snapshot = self._scan
+        self._scan = None
+        if snapshot is None:
+            snapshot = dirsnapshot.DirectorySnapshot(self.directory, filter=self._wanted)
+        if self._snapshot is None:
+            names = sorted(snapshot)
+            removed = [name for name in self._entries if not name in snapshot]
+        else:
+            diff = self._snapshot.diff(snapshot)
+            names = diff.changed
+            removed = diff.removed
+        for name in removed:
+            changed = self._drop_file(name) or changed
+        for name in names:
+            changed = self._add_file(name)[1] or changed
+        self._snapshot = snapshot
+        if not self._cache is None:
+            self._cache.commit()
+        return changed
+
+    def apply(self, added=(), removed=()):
+        '''
+        Splices single files into the index without rescanning the
+        directory.
+
+        :param added: Basenames of new or replaced files.
+        :param removed: Basenames of deleted files.
+        :returns: :const:`True` if the index changed.
+        '''
+        changed = False
+        for name in removed:
+            changed = self._drop_file(name) or changed
+        for name in added:
+            if not name.endswith(self.suffixes[self.typ]):
+                continue
+            changed = self._add_file(name)[1] or changed
+        # don't report our own changes on the next update
+        for snapshot in (self._snapshot, self._scan):
+            if not snapshot is None:
+                snapshot.refresh(list(removed) + list(added))
+        if not self._cache is None:
+            self._cache.commit()
+        return changed
+
+    def _stanza_file(self, stanza):
+        '''
+        Returns basename and size of the file described by the index file
+        *stanza*.
+        '''
+        if self.typ == 'packages':
+            return os.path.basename(stanza['filename']), int(stanza['size'])
+        files = stanza['files']
+        if not isinstance(files, list):
+            files = [files]
+        for line in files:
+            fields = line.split()
+            if len(fields) == 3 and fields[2].endswith('.dsc'):
+                return fields[2], int(fields[1])
+        raise KeyError('files')
+
+    def load(self, buf, mtime_ns):
+        '''
+        Takes the stanzas of an index file written before, so the files
+        which didn't change since then don't have to be read again. Only
+        the fields identifying the file are decoded.
+
+        :param buf: The content of the index file (:class:`bytes` or
+                    :class:`mmap.mmap`).
+        :param mtime_ns: Modification time of the index file. Files
+                         changed or moved into the directory later are
+                         skipped.
+        :returns: The number of stanzas taken.
+        '''
+        taken = 0
+        for stanza in iter_lazy_paragraphs(buf):
+            try:
+                name, size = self._stanza_file(stanza)
+            except (KeyError, ValueError):
+                continue
+            if name in self._entries or not self._wanted(name):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            # renaming a file changes its ctime, but not its mtime
+            if st.st_size != size or max(st.st_mtime_ns, st.st_ctime_ns) > mtime_ns:
+                continue
+            self._entries[name] = IndexEntry(stat_key(st), stanza.text())
+            taken += 1
+        return taken
+
+    def write(self, f, filter=None):
+        '''
+        Writes the index to the file like object *f*.
+
+        :param filter: Optional callable which gets the basename of a file
+                       and returns whether its stanza should be written.
+        '''
+        for name in sorted(self._entries):
+            if not filter is None and not filter(name):
+                continue
+            f.write(self._entries[name].stanza)
+            f.write('\n')
+
+
+def is_indexed_file(name):
+    '''
+    Whether *name* is a file read into one of the index files.
+    '''
+    return name.endswith(PackageIndex.suffixes['packages'] + PackageIndex.suffixes['sources'])
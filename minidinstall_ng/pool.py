@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# pool -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+The "pool" archive style.
+
+Like in the Debian archive the files of a source package and its binaries
+are stored in ``pool/<prefix>/<source>/``, where the prefix is the first
+letter of the source name (the first four for ``lib*`` packages). So no
+directory gets very big, and installing an upload only has to look at
+the directory of its own source.
+
+The index files are ``<arch>/Packages`` and ``source/Sources``, each with
+its own Release file, like with the "simple-subdir" style.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import os
+
+from minidinstall_ng import archiveindex
+from minidinstall_ng import compression
+from minidinstall_ng import metacache
+from minidinstall_ng import packageindex
+from minidinstall_ng.dist_worker import ArchiveDir, ArchiveDirIndexer
+
+#: Name of the pool directory in the archive
+POOL = 'pool'
+
+def pool_prefix(source):
+    '''
+    The name of the pool subdirectory of *source*.
+    '''
+    if source.startswith('lib') and len(source) > 3:
+        return source[:4]
+    return source[:1]
+
+def _binary_arch(name):
+    match = archiveindex.debpackage_re.search(name)
+    if match:
+        return match.group(3)
+    return None
+
+
+class PoolArchiveDirIndexer(ArchiveDirIndexer):
+    '''
+    Every source directory of the pool has its own
+    :class:`minidinstall_ng.packageindex.PackageIndex` objects. The index
+    files are put together from them, so after an installation only the
+    directory of the installed source is read.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        ArchiveDirIndexer.__init__(self, *args, **kwargs)
+        for dir in [POOL, 'source'] + list(self.config.arches):
+            os.makedirs(self._abspath(dir), exist_ok=True)
+        self._cache = None
+
+    def _get_cache(self, directory):
+        if self.config.shared_pool:
+            return ArchiveDirIndexer._get_cache(self, directory)
+        # one cache for the whole pool instead of one per directory
+        if self._cache is None:
+            self._cache = metacache.MetadataCache(self._abspath(POOL + '.db'))
+        return self._cache
+
+    def _pool_dirs(self):
+        '''
+        Lists the source directories of the pool, relative like the
+        directories of the indices.
+        '''
+        root = self._abspath(POOL)
+        for prefix in sorted(os.listdir(root)):
+            if not os.path.isdir(os.path.join(root, prefix)):
+                continue
+            for source in sorted(os.listdir(os.path.join(root, prefix))):
+                yield self._relpath(POOL, prefix, source)
+
+    def _pool_dir_of(self, filename):
+        '''
+        The pool directory of *filename* (an absolute path) like returned
+        by :meth:`_pool_dirs` or :const:`None` if it is not in the pool.
+        '''
+        directory = os.path.dirname(os.path.abspath(filename))
+        relative = os.path.relpath(directory, self._abspath())
+        parts = relative.split(os.sep)
+        if len(parts) != 3 or parts[0] != POOL:
+            return None
+        return self._relpath(*parts)
+
+    def _write_pool_indexfile(self, typ, arch):
+        '''
+        Writes ``<arch>/Packages`` (or ``source/Sources``) from the indices
+        of all pool directories.
+        '''
+        if self.no_act:
+            return
+        filename = self._abspath(arch, packageindex.INDEXFILE_NAMES[typ])
+        filter = None
+        if typ == 'packages':
+            filter = lambda name: _binary_arch(name) == arch
+        with compression.MultiCompressedFile(filename + '.new', 'wt',
+                                             formats=self.config.index_compression,
+                                             threaded=True) as indexfiles:
+            for (directory, t), index in sorted(self._indices.items()):
+                if t == typ:
+                    index.write(indexfiles, filter)
+        for ext in indexfiles.extensions:
+            os.rename(filename + '.new' + ext, filename + ext)
+
+    def _index(self, arches, force=None):
+        dirs = list(self._pool_dirs())
+        changed = {'packages': force, 'sources': force}
+        known = set(dirs)
+        for (directory, typ) in list(self._indices):
+            if not directory in known:
+                # the whole source is gone
+                del self._indices[(directory, typ)]
+                changed[typ] = True
+        for directory in dirs:
+            for typ in ('packages', 'sources'):
+                index = self._get_index(directory, typ)
+                if index.changed(rescan=False):
+                    changed[typ] = index.update() or changed[typ]
+        for arch in self.config.arches:
+            if changed['packages'] or not os.access(self._abspath(arch, 'Packages'), os.R_OK):
+                self.logger.info('Generating Packages file for %s...' % (arch,))
+                self._write_pool_indexfile('packages', arch)
+        if changed['sources'] or not os.access(self._abspath('source', 'Sources'), os.R_OK):
+            self.logger.info('Generating Sources file...')
+            self._write_pool_indexfile('sources', 'source')
+
+    def _apply_delta(self, delta):
+        '''
+        Updates the indices of the pool directories touched by a single
+        installation and rewrites the affected index files.
+        '''
+        files = {}
+        for filename in delta.added:
+            directory = self._pool_dir_of(filename)
+            if not directory is None:
+                files.setdefault(directory, ([], []))[0].append(os.path.basename(filename))
+        for filename in delta.removed:
+            directory = self._pool_dir_of(filename)
+            if not directory is None:
+                files.setdefault(directory, ([], []))[1].append(os.path.basename(filename))
+        arches = set()
+        for directory, (added, removed) in files.items():
+            for typ in ('packages', 'sources'):
+                index = self._get_index(directory, typ)
+                self.logger.debug('Patching %s index of %s' % (typ, directory))
+                if not index.apply(added, removed):
+                    continue
+                if typ == 'sources':
+                    arches.add('source')
+                    continue
+                for name in added + removed:
+                    arch = _binary_arch(name)
+                    if arch in self.config.arches:
+                        arches.add(arch)
+        for arch in sorted(arches):
+            self._write_pool_indexfile('sources' if arch == 'source' else 'packages', arch)
+        if arches:
+            self._gen_release(sorted(arches))
+
+    def _gen_release(self, arches, force=False):
+        known = list(self.config.arches) + ['source']
+        if [arch for arch in arches if not arch in known]:
+            # a change in the pool may concern any index
+            arches = known
+        for arch in arches:
+            release_file = self._abspath(arch, 'Release')
+            if not self.config.generate_release:
+                if os.access(release_file, os.R_OK):
+                    self.logger.info("Release generation disabled, removing existing Release file")
+                    try:
+                        os.unlink(release_file)
+                    except OSError:
+                        pass
+                continue
+            if not force and not self._get_release_needed(release_file):
+                self.logger.info("Skipping Release generation for %s" % arch)
+                continue
+            self.logger.info("Generating Release for %s..." % arch)
+            if self.no_act:
+                continue
+            tmp_release_file = release_file + '.new'
+            with open(tmp_release_file, 'w') as f:
+                self._write_origin_to(f)
+                self._write_label_to(f)
+                self._write_suite_to(f)
+                codename = self.config.release_codename
+                if not codename:
+                    codename = self.config.release_suite or self.name
+                f.write('Codename: ' + '%s/%s\n' % (codename, arch))
+                self._write_no_automatic_to(f)
+                self._write_date_to(f)
+                f.write('Architectures: ' + arch + '\n')
+                if self.config.release_description:
+                    f.write('Description: ' + self.config.release_description + '\n')
+                indexfiles = [x for x in self._get_all_indexfiles() if x.startswith(arch + '/')]
+                self._hash_files_to(indexfiles, f)
+            if self._sign_releasefile(os.path.basename(tmp_release_file), self._abspath(arch)):
+                os.rename(tmp_release_file, release_file)
+                self.logger.info("Release generation complete")
+
+    def _gen_release_all(self, force=False):
+        self._gen_release(list(self.config.arches) + ['source'], force)
+
+    def _get_dnotify_dirs(self):
+        # installations are reported with index deltas; watching the top
+        # of the pool notices new sources added by hand
+        return [self._abspath(POOL)]
+
+    def _get_uncompressed_indexfiles(self):
+        return [os.path.join(arch, 'Packages') for arch in self.config.arches] + ['source/Sources']
+
+
+class PoolArchiveDir(ArchiveDir):
+
+    indexer_class = PoolArchiveDirIndexer
+
+    def _pool_dir(self, source):
+        return os.path.join(self.directory, POOL, pool_prefix(source), source)
+
+    def _arch_target(self, arch, file, source=None):
+        return os.path.join(self._pool_dir(source), file)
+
+    def _source_target(self, file, source=None):
+        return os.path.join(self._pool_dir(source), file)
+
+    def _changes_target(self, changefilename, source):
+        return os.path.join(self._pool_dir(source), os.path.basename(changefilename))
+
+    def _get_file_index(self, source=None):
+        '''
+        Indexes only the directory of *source*, which holds all its files,
+        or the whole pool if *source* is :const:`None`.
+        '''
+        if source is None:
+            root = os.path.join(self.directory, POOL)
+            dirs = [os.path.join(root, prefix, name)
+                    for prefix in os.listdir(root)
+                    for name in os.listdir(os.path.join(root, prefix))]
+        else:
+            dirs = [self._pool_dir(source)]
+        index = archiveindex.ArchiveFileIndex()
+        for directory in dirs:
+            if not os.path.isdir(directory):
+                continue
+            for file in os.listdir(directory):
+                path = os.path.join(directory, file)
+                index.add_binary(path) or index.add_source(path)
+        return index
+
+    def _install_changefile_internal(self, changefilename, changefile, changestarget):
+        os.makedirs(self._pool_dir(changefile['source']), exist_ok=True)
+        return ArchiveDir._install_changefile_internal(self, changefilename, changefile, changestarget)
@@ -1,80 +1,107 @@
+#!/usr/bin/env python3
+# simplesubdir -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+The "simple-subdir" archive style.
+
+The files of a distribution are stored in one subdirectory per
+architecture and ``source``, each with its own index and Release file.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import os
+
+from minidinstall_ng.dist_worker import ArchiveDir, ArchiveDirIndexer
 
 class SimpleSubdirArchiveDirIndexer(ArchiveDirIndexer):
 
     def __init__(self, *args, **kwargs):
-        apply(ArchiveDirIndexer.__init__, [self] + list(args), kwargs)
-        for arch in list(self._arches) + ['source']:
-            target = os.path.join(self._dir, arch)
-            do_mkdir(target)
+        ArchiveDirIndexer.__init__(self, *args, **kwargs)
+        for arch in list(self.config.arches) + ['source']:
+            os.makedirs(self._abspath(arch), exist_ok=True)
 
     def _index(self, arches, force=None):
         for arch in arches:
-            dirmtime = os.stat(self._relpath(arch)).st_mtime
             if arch != 'source':
-                pkgsfile = self._relpath(arch, 'Packages')
-                if force or (not os.access(pkgsfile, os.R_OK)) or dirmtime > os.stat(pkgsfile).st_mtime:
-                    self._logger.info('Generating Packages file for %s...' % (arch,))
+                pkgsfile = self._abspath(arch, 'Packages')
+                if force or (not os.access(pkgsfile, os.R_OK)) or self._index_changed(self._relpath(arch), 'packages'):
+                    self.logger.info('Generating Packages file for %s...' % (arch,))
                     self._make_packagesfile(self._relpath(arch))
-                    self._logger.info('Packages generation complete')
+                    self.logger.info('Packages generation complete')
                 else:
-                    self._logger.info('Skipping generation of Packages file for %s' % (arch,))
+                    self.logger.info('Skipping generation of Packages file for %s' % (arch,))
 
             else:
-                pkgsfile = self._relpath(arch, 'Sources')
-                if force or (not os.access(pkgsfile, os.R_OK)) or dirmtime > os.stat(pkgsfile).st_mtime:
-                    self._logger.info('Generating Sources file for %s...' % (arch,))
+                pkgsfile = self._abspath(arch, 'Sources')
+                if force or (not os.access(pkgsfile, os.R_OK)) or self._index_changed(self._relpath('source'), 'sources'):
+                    self.logger.info('Generating Sources file for %s...' % (arch,))
                     self._make_sourcesfile(self._relpath('source'))
-                    self._logger.info('Sources generation complete')
+                    self.logger.info('Sources generation complete')
                 else:
-                    self._logger.info('Skipping generation of Sources file for %s' % (arch,))
+                    self.logger.info('Skipping generation of Sources file for %s' % (arch,))
 
-    def _gen_release(self, arches, force):
+    def _gen_release(self, arches, force=False):
         for arch in arches:
-            release_file = self._relpath(arch, 'Release')
-            if not self._generate_release:
+            release_file = self._abspath(arch, 'Release')
+            if not self.config.generate_release:
                 if os.access(release_file, os.R_OK):
-                    self._logger.info("Release generation disabled, removing existing Release file")
+                    self.logger.info("Release generation disabled, removing existing Release file")
                     try:
                         os.unlink(release_file)
-                    except OSError, e:
+                    except OSError:
                         pass
-                return
-            tmp_release_file = release_file + tmp_new_suffix
-            if not self.release_needed:
-                self._logger.info("Skipping Release generation")
                 continue
-            self._logger.info("Generating Release...")
-            if no_act:
-                self._logger.info("Release generation complete")
-                return
-            f = open(tmp_release_file, 'w')
-            self._write_origin_to(f)
-            self._write_label_to(f)
-            self._write_suite_to(f)
-
-            codename = self._release_codename
-            if not codename:
-                codename = suite
-            f.write('Codename: ' + '%s/%s\n' % (codename, arch))
-            self._write_no_automatic_to(f)
-            self._write_date_to(f)
-            f.write('Architectures: ' + arch + '\n')
-            if self._release_description:
-                f.write('Description: ' + self._release_description + '\n')
-            self._hash_files_to(indexfiles, f)
-            f.close()
+            tmp_release_file = release_file + '.new'
+            if not force and not self._get_release_needed(release_file):
+                self.logger.info("Skipping Release generation")
+                continue
+            self.logger.info("Generating Release...")
+            if self.no_act:
+                self.logger.info("Release generation complete")
+                continue
+            with open(tmp_release_file, 'w') as f:
+                self._write_origin_to(f)
+                self._write_label_to(f)
+                self._write_suite_to(f)
+
+                codename = self.config.release_codename
+                if not codename:
+                    codename = self.config.release_suite or self.name
+                f.write('Codename: ' + '%s/%s\n' % (codename, arch))
+                self._write_no_automatic_to(f)
+                self._write_date_to(f)
+                f.write('Architectures: ' + arch + '\n')
+                if self.config.release_description:
+                    f.write('Description: ' + self.config.release_description + '\n')
+                indexfiles = [x for x in self._get_all_indexfiles() if x.startswith(arch + '/')]
+                self._hash_files_to(indexfiles, f)
             if self._sign_releasefile(os.path.basename(tmp_release_file), self._abspath(arch)):
                 os.rename(tmp_release_file, release_file)
-                self._logger.info("Release generation complete")
+                self.logger.info("Release generation complete")
 
-    def _in_archdir(self, *args):
-        return apply(lambda x,self=self: self._abspath(x), args)
+    def _gen_release_all(self, force=False):
+        self._gen_release(list(self.config.arches) + ['source'], force)
 
     def _get_dnotify_dirs(self):
-        return map(lambda x, self=self: self._abspath(x), self._arches + ['source'])
+        return [self._abspath(x) for x in list(self.config.arches) + ['source']]
 
     def _get_uncompressed_indexfiles(self):
-        return [os.path.join(arch, 'Packages') for arch in self._arches] + ['source/Sources']
+        return [os.path.join(arch, 'Packages') for arch in self.config.arches] + ['source/Sources']
 
 
 class SimpleSubdirArchiveDir(ArchiveDir):
@@ -82,10 +109,9 @@ class SimpleSubdirArchiveDir(ArchiveDir):
     indexer_class = SimpleSubdirArchiveDirIndexer
 
     def __init__(self, *args, **kwargs):
-        apply(ArchiveDir.__init__, [self] + list(args), kwargs)
-        for arch in list(self._arches) + ['source']:
-            target = os.path.join(self._dir, arch)
-            do_mkdir(target)
+        ArchiveDir.__init__(self, *args, **kwargs)
+        for arch in list(self.config.arches) + ['source']:
+            os.makedirs(self._abspath(arch), exist_ok=True)
 
     def _read_source_dir(self):
         return os.listdir(self._abspath('source'))
@@ -93,17 +119,86 @@ class SimpleSubdirArchiveDir(ArchiveDir):
     def _read_arch_dir(self, arch):
         return os.listdir(self._abspath(arch))
 
-    def _arch_target(self, arch, file):
+    def _arch_target(self, arch, file, source=None):
         return self._abspath(arch, file)
 
-    def _source_target(self, file):
+    def _source_target(self, file, source=None):
         return self._arch_target('source', file)
 
-    def _get_package_versions(self):
-        ret = []
-        for arch in self._arches:
-            for file in self._read_arch_dir(arch):
-                match = debpackage_re.search(file)
-                if match:
-                    ret.append((match.group(1), match.group(2), match.group(3)))
-        return ret
+
+if __name__ == '__main__':
+    import logging
+    import shutil
+    import tempfile
+    import threading
+    import unittest
+
+    from minidinstall_ng import compression
+
+    class Config(dict):
+        __getattr__ = dict.__getitem__
+
+    class TestSimpleSubdir(unittest.TestCase):
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.directory = os.path.join(self.dir, 'unstable')
+            self.logger = logging.getLogger('test')
+            self.logger.disabled = True
+            self.config = Config(arches=['all', 'amd64'], shared_pool=None, use_db=False,
+                                 index_compression=list(compression.default_formats),
+                                 generate_release=True, release_origin='test',
+                                 release_label='test', release_suite=None,
+                                 release_codename=None, experimental_release=False,
+                                 release_description=None, release_signscript=None)
+            # the constructors need the daemon's globals; set up what is used
+            self.archive = self._make(SimpleSubdirArchiveDir)
+            self.archive._file_index = None
+            self.indexer = SimpleSubdirArchiveDirIndexer.__new__(SimpleSubdirArchiveDirIndexer)
+            threading.Thread.__init__(self.indexer, name='unstable')
+            self._make(self.indexer)
+            self.indexer.no_act = False
+            self.indexer._indices = {}
+            self.indexer._release_needed_event = threading.Event()
+            self.cwd = os.getcwd()
+            # the indices use paths relative to the parent directory
+            os.chdir(self.dir)
+
+        def tearDown(self):
+            os.chdir(self.cwd)
+            shutil.rmtree(self.dir)
+
+        def _make(self, obj):
+            if isinstance(obj, type):
+                obj = obj.__new__(obj)
+            obj.directory = self.directory
+            obj.name = 'unstable'
+            obj.logger = self.logger
+            obj.config = self.config
+            return obj
+
+        def _touch(self, path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+        def test_file_index(self):
+            for arch in self.config.arches + ['source']:
+                os.makedirs(os.path.join(self.directory, arch))
+            deb = self.archive._arch_target('amd64', 'foo_1.0-1_amd64.deb')
+            dsc = self.archive._source_target('foo_1.0-1.dsc')
+            self.assertEqual(deb, os.path.join(self.directory, 'amd64', 'foo_1.0-1_amd64.deb'))
+            self.assertEqual(dsc, os.path.join(self.directory, 'source', 'foo_1.0-1.dsc'))
+            self._touch(deb)
+            self._touch(dsc)
+            index = self.archive._get_file_index()
+            self.assertEqual(index.get_binaries('foo', 'amd64'), {deb: '1.0-1'})
+            self.assertEqual(index.get_sources('foo'), {dsc: ('dsc', '1.0-1')})
+
+        def test_index(self):
+            for arch in self.config.arches + ['source']:
+                os.makedirs(os.path.join(self.directory, arch))
+            self.indexer._index_all(force=True)
+            self.indexer._gen_release_all(force=True)
+            for name in ['all/Packages', 'amd64/Packages.bz2', 'amd64/Release', 'source/Sources', 'source/Release']:
+                self.assertTrue(os.path.exists(os.path.join(self.directory, name)), name)
+
+    unittest.main()
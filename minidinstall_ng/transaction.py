@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# transaction -*- mode: python; coding: utf-8 -*-
+#-----------------------------------------------------------------------------
+'''
+Journaled installation of the files of an upload.
+
+The new files are first staged next to their targets (hardlinked, reflinked
+or copied from incoming) while the journal is still uncommitted. Renaming
+the journal is the commit point; after that the staged files are renamed
+over their targets and the old files are deleted. Each directory is
+fsynced once per step.
+
+With a :class:`minidinstall_ng.blobstore.BlobStore` the files are staged
+from their blobs, so identical files share one inode across all
+distributions.
+
+If the daemon dies in between, :func:`recover` finishes a committed
+transaction or throws away the staged files of an uncommitted one. It
+only looks at the files named in the journal, so it doesn't matter how
+big the archive is.
+'''
+#-----------------------------------------------------------------------------
+# Copyright (C) 2014  c0ff3m4kr <l34k@bk.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+import errno
+import fcntl
+import json
+import os
+import shutil
+
+#: Name of the journal in the archive directory
+JOURNAL = '.mini-dinstall-journal'
+#: Suffix of the uncommitted journal
+PENDING_SUFFIX = '.pending'
+#: Suffix of the staged files
+STAGE_SUFFIX = '.dinstall-new'
+
+#: ioctl cloning a file on filesystems supporting reflinks (linux/fs.h)
+FICLONE = 0x40049409
+
+class TransactionException(Exception):
+
+    def __init__(self, value):
+        self._value = value
+
+    def __str__(self):
+        return str(self._value)
+
+def _fsync_dirs(dirs):
+    for dir in set(dirs):
+        fd = os.open(dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def copy_file(source, dst):
+    '''
+    Writes the content of the file *source* to the open file *dst*, as a
+    reflink if possible.
+    '''
+    with open(source, 'rb') as src:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst)
+
+def stage_file(source, target):
+    '''
+    Makes *target* a copy of *source*: a hardlink if possible, else a
+    reflink and as last resort a real copy.
+
+    :returns: :const:`True` if data was written, so *target* still has to
+              be fsynced.
+    '''
+    try:
+        os.link(source, target)
+        return False
+    except OSError as e:
+        if not e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    with open(target, 'wb') as dst:
+        copy_file(source, dst)
+    shutil.copystat(source, target)
+    return True
+
+class InstallTransaction(object):
+    '''
+    Collects the files to install and to remove and applies them with
+    :meth:`commit`.
+
+    :param directory: The archive directory, which holds the journal.
+    :param logger: Logger object.
+    :param blobstore: Optional :class:`minidinstall_ng.blobstore.BlobStore`.
+    '''
+
+    def __init__(self, directory, logger, blobstore=None):
+        self.directory = directory
+        self.logger = logger
+        self.blobstore = blobstore
+        self.journal = os.path.join(directory, JOURNAL)
+        #: (source, target, sha256) tuples
+        self.installs = []
+        #: (path, sha256) pairs of the files to delete
+        self.removes = []
+
+    def install(self, source, target, sha256=None):
+        '''
+        :param sha256: The verified SHA256 of *source*. Only files with a
+                       known hash are put into the blob store.
+        '''
+        self.installs.append((os.path.abspath(source), os.path.abspath(target), sha256))
+
+    def remove(self, path, sha256=None):
+        '''
+        :param sha256: The SHA256 of *path* if known, to find its blob
+                       without reading it.
+        '''
+        self.removes.append((os.path.abspath(path), sha256))
+
+    def _write_journal(self, data):
+        pending = self.journal + PENDING_SUFFIX
+        with open(pending, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return pending
+
+    def commit(self):
+        '''
+        Installs the files. On errors before the commit point nothing is
+        changed and the exception is raised again. Errors after it are
+        only logged: the transaction is committed, and its journal is kept
+        so :func:`recover` completes it.
+
+        A journal left by an earlier transaction is completed first.
+
+        :returns: :const:`True` if all files are in place, :const:`False`
+                  if the transaction is committed but still has to be
+                  completed.
+        :raises TransactionException: If an earlier transaction can't be
+                                      completed.
+        '''
+        if os.path.exists(self.journal):
+            try:
+                recover(self.directory, self.logger, self.blobstore)
+            except Exception as e:
+                raise TransactionException('Unfinished transaction in "%s": %s' % (self.directory, e))
+        targets = set(target for source, target, sha256 in self.installs)
+        removes = [(path, sha256) for path, sha256 in self.removes if not path in targets]
+        installs = []
+        for source, target, sha256 in self.installs:
+            blob = None
+            if not self.blobstore is None and not sha256 is None:
+                blob = self.blobstore.path(sha256)
+            installs.append((source, target + STAGE_SUFFIX, target, blob))
+        pending = self._write_journal({'installs': installs, 'removes': removes})
+        staged = []
+        try:
+            dirty = []
+            for source, stage, target, blob in installs:
+                self.logger.debug('Staging "%s" as "%s"' % (source, stage))
+                _unlink(stage)
+                if blob is None:
+                    written = stage_file(source, stage)
+                else:
+                    # blobs are named after their hash
+                    written = self.blobstore.stage(source, os.path.basename(blob), stage)
+                if written:
+                    dirty.append(stage)
+                staged.append(stage)
+            for stage in dirty:
+                with open(stage, 'rb') as f:
+                    os.fsync(f.fileno())
+            _fsync_dirs([os.path.dirname(stage) for stage in staged])
+            # the commit point
+            os.rename(pending, self.journal)
+            _fsync_dirs([self.directory])
+        except Exception:
+            self.logger.exception('Failed to stage files; rolling back')
+            for stage in staged:
+                _unlink(stage)
+            _drop_unused_blobs(installs, self.blobstore)
+            _unlink(pending)
+            raise
+        try:
+            _apply(self.journal, {'installs': installs, 'removes': removes}, self.logger,
+                   self.blobstore)
+        except Exception:
+            self.logger.exception('Failed to complete the installation in "%s"; '
+                                  'it is completed by the next one' % self.directory)
+            return False
+        return True
+
+def _drop_unused_blobs(installs, blobstore=None):
+    '''
+    Removes the blobs of the uncommitted *installs* which nothing links to.
+    '''
+    blobs = [entry[3] for entry in installs if len(entry) > 3 and not entry[3] is None]
+    if not blobstore is None:
+        blobstore.drop_unused(blobs)
+        return
+    for blob in blobs:
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.unlink(blob)
+        except OSError:
+            pass
+
+def _apply(journal, data, logger, blobstore=None):
+    '''
+    Finishes the committed transaction *data*. Every step can be repeated,
+    so this is also used for recovery.
+    '''
+    dirs = []
+    for entry in data['installs']:
+        source, stage, target = entry[:3]
+        if os.path.exists(stage):
+            logger.debug('Installing "%s"' % target)
+            if os.path.exists(target) and os.path.samefile(stage, target):
+                # both link to the same blob; rename() would do nothing
+                os.unlink(stage)
+            else:
+                if not blobstore is None:
+                    # the replaced file may have been the last link to its blob
+                    blobstore.release(target)
+                os.rename(stage, target)
+        dirs.append(os.path.dirname(target))
+    for entry in data['removes']:
+        # journals of older versions have only the paths
+        path, sha256 = (entry, None) if isinstance(entry, str) else entry
+        logger.debug('Deleting "%s"' % path)
+        if not blobstore is None:
+            blobstore.release(path, sha256)
+        _unlink(path)
+        dirs.append(os.path.dirname(path))
+    _fsync_dirs(dirs)
+    # only now the uploaded files may go away
+    dirs = []
+    for entry in data['installs']:
+        source = entry[0]
+        _unlink(source)
+        dirs.append(os.path.dirname(source))
+    _fsync_dirs(dirs)
+    os.unlink(journal)
+    _fsync_dirs([os.path.dirname(journal)])
+
+def recover(directory, logger, blobstore=None):
+    '''
+    Completes a committed transaction left in *directory* or rolls back
+    an uncommitted one.
+
+    :returns: :const:`True` if there was something to do.
+    '''
+    journal = os.path.join(directory, JOURNAL)
+    pending = journal + PENDING_SUFFIX
+    if os.path.exists(journal):
+        with open(journal) as f:
+            data = json.load(f)
+        logger.warning('Completing interrupted installation in "%s"' % directory)
+        _apply(journal, data, logger, blobstore)
+        _unlink(pending)
+        return True
+    if os.path.exists(pending):
+        logger.warning('Rolling back interrupted installation in "%s"' % directory)
+        try:
+            with open(pending) as f:
+                data = json.load(f)
+        except ValueError:
+            # the journal itself wasn't written completely; nothing was
+            # staged yet
+            data = {'installs': []}
+        for entry in data['installs']:
+            _unlink(entry[1])
+        _drop_unused_blobs(data['installs'], blobstore)
+        os.unlink(pending)
+        _fsync_dirs([directory])
+        return True
+    return False
+
+
+if __name__ == '__main__':
+    import logging
+    import tempfile
+    import unittest
+
+    from minidinstall_ng import hasher
+
+    class TestInstallTransaction(unittest.TestCase):
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.incoming = os.path.join(self.dir, 'incoming')
+            self.archive = os.path.join(self.dir, 'unstable')
+            os.mkdir(self.incoming)
+            os.mkdir(self.archive)
+            self.logger = logging.getLogger('test')
+            self.logger.disabled = True
+            for name in ('foo_2_all.deb', 'foo_2.dsc'):
+                with open(os.path.join(self.incoming, name), 'w') as f:
+                    f.write(name)
+            with open(os.path.join(self.archive, 'foo_1_all.deb'), 'w') as f:
+                f.write('old')
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _transaction(self):
+            txn = InstallTransaction(self.archive, self.logger)
+            for name in ('foo_2_all.deb', 'foo_2.dsc'):
+                txn.install(os.path.join(self.incoming, name), os.path.join(self.archive, name))
+            txn.remove(os.path.join(self.archive, 'foo_1_all.deb'))
+            return txn
+
+        def test_commit(self):
+            self._transaction().commit()
+            self.assertEqual(sorted(os.listdir(self.archive)), ['foo_2.dsc', 'foo_2_all.deb'])
+            self.assertEqual(os.listdir(self.incoming), [])
+
+        def test_recover_committed(self):
+            txn = self._transaction()
+            # die right after the commit point
+            apply = globals()['_apply']
+            globals()['_apply'] = lambda *args: None
+            try:
+                txn.commit()
+            finally:
+                globals()['_apply'] = apply
+            self.assertTrue(recover(self.archive, self.logger))
+            self.assertEqual(sorted(os.listdir(self.archive)), ['foo_2.dsc', 'foo_2_all.deb'])
+            self.assertFalse(recover(self.archive, self.logger))
+
+        def test_apply_fails(self):
+            txn = self._transaction()
+            apply = globals()['_apply']
+            def fail(*args):
+                raise OSError(errno.EIO, 'I/O error')
+            globals()['_apply'] = fail
+            try:
+                self.assertFalse(txn.commit())
+            finally:
+                globals()['_apply'] = apply
+            self.assertTrue(os.path.exists(os.path.join(self.archive, JOURNAL)))
+            # the next transaction completes it first
+            with open(os.path.join(self.incoming, 'bar_1.dsc'), 'w') as f:
+                f.write('bar')
+            txn = InstallTransaction(self.archive, self.logger)
+            txn.install(os.path.join(self.incoming, 'bar_1.dsc'),
+                        os.path.join(self.archive, 'bar_1.dsc'))
+            self.assertTrue(txn.commit())
+            self.assertEqual(sorted(os.listdir(self.archive)),
+                             ['bar_1.dsc', 'foo_2.dsc', 'foo_2_all.deb'])
+
+        def test_rollback(self):
+            txn = self._transaction()
+            txn.install(os.path.join(self.incoming, 'missing.deb'),
+                        os.path.join(self.archive, 'missing.deb'))
+            self.assertRaises(OSError, txn.commit)
+            self.assertEqual(os.listdir(self.archive), ['foo_1_all.deb'])
+            self.assertEqual(len(os.listdir(self.incoming)), 2)
+
+        def test_blobstore(self):
+            from minidinstall_ng.blobstore import BlobStore
+            store = BlobStore(os.path.join(self.dir, 'pool'))
+            other = os.path.join(self.dir, 'testing')
+            os.mkdir(other)
+            deb = os.path.join(self.incoming, 'foo_2_all.deb')
+            sha256 = hasher.hash_file(deb, 'sha256')
+            shutil.copy(deb, deb + '.copy')
+            shutil.copy(deb, deb + '.again')
+            # the last one installs the same file again
+            for source, archive in ((deb, self.archive), (deb + '.copy', other),
+                                    (deb + '.again', other)):
+                txn = InstallTransaction(archive, self.logger, store)
+                txn.install(source, os.path.join(archive, 'foo_2_all.deb'), sha256)
+                txn.commit()
+            self.assertEqual(os.listdir(other), ['foo_2_all.deb'])
+            st = os.stat(os.path.join(other, 'foo_2_all.deb'))
+            self.assertTrue(os.path.samestat(st, os.stat(store.path(sha256))))
+            self.assertEqual(st.st_nlink, 3)
+            for archive in (self.archive, other):
+                txn = InstallTransaction(archive, self.logger, store)
+                txn.remove(os.path.join(archive, 'foo_2_all.deb'), sha256)
+                txn.commit()
+            self.assertFalse(os.path.exists(store.path(sha256)))
+
+        def test_blobstore_replace(self):
+            from minidinstall_ng.blobstore import BlobStore
+            store = BlobStore(os.path.join(self.dir, 'pool'))
+            target = os.path.join(self.archive, 'foo_2_all.deb')
+            blobs = []
+            for data in ('old', 'new'):
+                source = os.path.join(self.incoming, 'foo_2_all.deb')
+                with open(source, 'w') as f:
+                    f.write(data)
+                sha256 = hasher.hash_file(source, 'sha256')
+                txn = InstallTransaction(self.archive, self.logger, store)
+                txn.install(source, target, sha256)
+                self.assertTrue(txn.commit())
+                blobs.append(store.path(sha256))
+            self.assertFalse(os.path.exists(blobs[0]))
+            self.assertTrue(os.path.samefile(blobs[1], target))
+
+    unittest.main()